@@ -0,0 +1,134 @@
+#!/usr/bin/env python
+
+# ---------------------------------------------------------
+#     Integer encoding and lookup tables for haplotag
+#   barcodes, used by parse_haptag_barcodes.py to match
+#     and correct barcodes in batches of index reads
+# ---------------------------------------------------------
+
+# Each 6 bp barcode is 2-bit encoded (A=0, C=1, G=2, T=3) into an integer
+# between 0 and 4^6-1. Sequences containing anything other than ACGT get
+# the extra code INVALID, so every table has 4^6+1 entries and can be
+# indexed directly with an array of encoded barcodes.
+
+import itertools
+import numpy as np
+
+BARCODE_LENGTH = 6
+
+N_BARCODES = 4**BARCODE_LENGTH
+
+INVALID = N_BARCODES
+
+#lookup from ascii value to 2-bit base code (4 for anything that is not ACGT)
+base_codes = np.full(256, 4, dtype=np.int64)
+for i, base in enumerate("ACGT"): base_codes[ord(base)] = i
+
+#value of each position in the encoded barcode (most significant base first)
+place_values = 4**np.arange(BARCODE_LENGTH - 1, -1, -1, dtype=np.int64)
+
+#sequence of each encoded barcode, in code order
+barcode_strings = ["".join(bases) for bases in itertools.product("ACGT", repeat=BARCODE_LENGTH)] + ["N"*BARCODE_LENGTH]
+
+#encode a batch of barcodes, each being seq[start:end] (to the end of the sequence by default)
+#segments that are not exactly BARCODE_LENGTH long (e.g. from index reads that are not 13 bp) can't be
+#matched, so they get INVALID, as they had no match in the barcode dictionaries
+def encode_barcodes(seqs, start=0, end=None):
+    segments = [seq[start:end] for seq in seqs]
+    joined = "".join([segment if len(segment) == BARCODE_LENGTH else "N"*BARCODE_LENGTH for segment in segments])
+    bases = base_codes[np.frombuffer(joined.encode(), dtype=np.uint8).reshape(-1, BARCODE_LENGTH)]
+    codes = bases.dot(place_values)
+    codes[(bases == 4).any(axis=1)] = INVALID
+    return codes
+
+#encode a single barcode
+def encode_barcode(seq):
+    return int(encode_barcodes([seq])[0]) if len(seq) == BARCODE_LENGTH else INVALID
+
+#make an array that gives the corrected code for every possible encoded barcode
+#barcodes that can not be corrected map to themselves, as with mirror_dict
+def make_barcode_lookup(correction_dict=None):
+    lookup = np.arange(N_BARCODES + 1, dtype=np.int64)
+    if correction_dict:
+        for alt_bc, bc in correction_dict.items():
+            alt_code, code = encode_barcode(alt_bc), encode_barcode(bc)
+            if alt_code == INVALID or code == INVALID: continue
+            lookup[alt_code] = code
+    return lookup
+
+#this class is a bit like a defaultdict, but it doesn not store the missing thing 
+class missing_dict(dict):
+    def __init__(self, missing):
+        self.missing=missing
+    def __missing__(self, key):
+        return self.missing
+
+#function to make a dictionary for matching a barcode (exactly or with one mismatch)
+def make_barcode_dict(barcode_file, missing):
+    d = missing_dict(missing)
+    with open(barcode_file, "rt") as BCfile:
+        for line in BCfile:
+            tag,bc = line.split()
+            if bc in d:
+                print("WARNING: Barcode {} is linked with both {} and {}.".format(bc, d[bc], tag))
+                d.pop(bc)
+                continue
+            d[bc] = tag
+    return(d)
+
+#make an array that gives the tag (e.g. A01) for every encoded barcode, or the missing tag if there is none
+def make_tag_table(barcode_dict, missing):
+    tags = np.full(N_BARCODES + 1, missing, dtype=object)
+    for bc, tag in barcode_dict.items():
+        code = encode_barcode(bc)
+        if code == INVALID:
+            print("WARNING: ignoring barcode {} because it is not a {} bp ACGT sequence.".format(bc, BARCODE_LENGTH))
+            continue
+        tags[code] = tag
+    return tags
+
+#counts of each encoded barcode for A, B, C and D
+#counters from separate runs (e.g. different lanes) can be merged by adding them together
+class BarcodeCounter:
+    def __init__(self):
+        self.counts = dict([(x, np.zeros(N_BARCODES + 1, dtype=np.int64),) for x in "ABCD"])
+    
+    #add a batch of encoded barcodes, given as a dictionary of arrays for A, B, C and D
+    def add(self, barcodes):
+        for x in "ABCD":
+            self.counts[x] += np.bincount(barcodes[x], minlength=N_BARCODES + 1)
+    
+    def merge(self, other):
+        for x in "ABCD":
+            self.counts[x] += other.counts[x]
+    
+    #counts are stored as one array per barcode in an uncompressed numpy .npz file
+    def save(self, filename):
+        with open(filename, "wb") as counts_file:
+            np.savez(counts_file, **self.counts)
+    
+    @classmethod
+    def load(cls, filename):
+        counter = cls()
+        with np.load(filename) as counts_file:
+            for x in "ABCD":
+                if counts_file[x].shape != counter.counts[x].shape:
+                    raise ValueError("Counts file {} does not contain counts for {} bp barcodes.".format(filename, BARCODE_LENGTH))
+                counter.counts[x] += counts_file[x]
+        return counter
+
+#write counts for one barcode as text, most common first, and return the number of matches and mismatches
+def write_barcode_counts(filename, counts, tags, missing, demult_dict=None):
+    seen = np.nonzero(counts)[0]
+    order = seen[np.argsort(-counts[seen], kind="stable")]
+    matches, mismatches = 0,0
+    with open(filename, "wt") as BCcounts_file:
+        for barcode in order:
+            output = [barcode_strings[barcode], tags[barcode]]
+            if demult_dict is not None:
+                output.append(demult_dict.get(tags[barcode], "-"))
+            output.append(str(counts[barcode]))
+            BCcounts_file.write("\t".join(output) + "\n")
+            if tags[barcode] == missing: mismatches += counts[barcode]
+            else: matches += counts[barcode]
+    return matches, mismatches
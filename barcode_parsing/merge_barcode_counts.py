@@ -0,0 +1,56 @@
+#!/usr/bin/env python
+
+# ---------------------------------------------------------
+#     Script to merge barcode counts from several runs
+#    of parse_haptag_barcodes.py with --count_barcodes
+# ---------------------------------------------------------
+
+# example usage:
+# python merge_barcode_counts.py -i lane1.barcode_counts.npz lane2.barcode_counts.npz --output_label all_lanes --output_dir /path/to/ouput/
+
+import argparse
+
+from barcode_tables import make_barcode_dict, make_tag_table
+from barcode_tables import BarcodeCounter, write_barcode_counts
+
+parser = argparse.ArgumentParser()
+
+parser.add_argument("-i", "--counts_files", help="Barcode counts files (.barcode_counts.npz) to merge", nargs="+", required = True)
+
+parser.add_argument("--output_label", help="Output file label", default="merged")
+parser.add_argument("--output_dir", help="Output file directory", default=".")
+
+parser.add_argument("--barcode_files", help="Barcode files for A B C D (separated by spaces)",
+                    nargs=4, required = False, default=["BC_A.txt", "BC_B.txt", "BC_C.txt", "BC_D.txt"])
+
+parser.add_argument("--demult_file", help="File giving C tag and sample name, to add sample names to the counts")
+
+args = parser.parse_args()
+
+###############################################################################
+
+missing = dict((x, x+"00",) for x in "ABCD")
+
+barcode_files = dict(zip(["A","B","C","D"], args.barcode_files))
+
+tag_tables = dict([(x, make_tag_table(make_barcode_dict(barcode_files[x], missing = missing[x]), missing[x]),) for x in "ABCD"])
+
+demult_dict = None
+if args.demult_file:
+    with open(args.demult_file, "rt") as df:
+        demult_dict = dict([line.split() for line in df])
+
+#add up the counts from all files
+barcodeCounts = BarcodeCounter()
+for counts_file in args.counts_files:
+    barcodeCounts.merge(BarcodeCounter.load(counts_file))
+
+barcodeCounts.save(args.output_dir + "/" + args.output_label + ".barcode_counts.npz")
+
+for x in "ABCD":
+    matches, mismatches = write_barcode_counts(args.output_dir + "/" + args.output_label + "." + x + ".counts.txt",
+                                               barcodeCounts.counts[x], tag_tables[x], missing[x], demult_dict)
+
+    print("\nBarcode " + x + ":")
+    print("Matches =", matches)
+    print("Misatches =", mismatches)
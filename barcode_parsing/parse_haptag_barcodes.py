@@ -12,25 +12,34 @@
 
 import argparse
 import gzip
-from collections import defaultdict
+import os, sys
 from multiprocessing import Process, SimpleQueue
 
+from barcode_tables import INVALID, barcode_strings, encode_barcodes, make_barcode_dict, make_barcode_lookup, make_tag_table
+from barcode_tables import BarcodeCounter, write_barcode_counts
+
+#the profiler is shared with the sv_detection scripts
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "sv_detection"))
+from profiling import Profiler, clear_profiles, merge_profiles
+
 #a simple read object
 class Read:
     def __init__(self,name,seq,qual):
         self.name = name
         self.seq = seq
         self.qual = qual
+        self.name_extension = ""
+        self.tags = []
     
     def as_text(self):
-        return "\n".join([self.name, self.seq, "+", self.qual])
-
-#this class is a bit like a defaultdict, but it doesn not store the missing thing 
-class missing_dict(dict):
-    def __init__(self, missing):
-        self.missing=missing
-    def __missing__(self, key):
-        return self.missing
+        name = "\t".join([self.name + self.name_extension] + [tag + ":Z:" + value for tag,value in self.tags])
+        return "\n".join([name, self.seq, "+", self.qual])
+    
+    #read name as it would be given in a sam/bam file (without @, comments or /1 and /2)
+    def query_name(self):
+        name = self.name[1:].split()[0]
+        if name.endswith("/1") or name.endswith("/2"): name = name[:-2]
+        return name
 
 #another dictionary class that just returns the key if it is missing
 class mirror_dict(dict):
@@ -54,31 +63,42 @@ complementTrans = str.maketrans("ACGT", "TGCA")
 def revComp(seq):
     return seq.translate(complementTrans)[::-1]
 
-#argsort function (borrowed) for writing observed barcodes in order
-def argsort(seq):
-    # http://stackoverflow.com/questions/3071415/efficient-method-to-calculate-the-rank-vector-of-a-list-in-python
-    return sorted(range(len(seq)), key=seq.__getitem__)
-
-def fastq_writer(queue, outfile_name):
+#if profiling, time spent waiting for reads is timed as transfer and writing them (with compression) as write
+def fastq_writer(queue, outfile_name, profile_dir=None):
+    profiler = Profiler(profile_dir, "fastq_writer").start()
     outfile = gzip.open(outfile_name, "wt")
+    get = profiler.timed("transfer", queue.get)
+    write = profiler.timed("write", outfile.write)
     while True:
-        read = queue.get()
+        read = get()
         if read == None: break #for ending process
-        outfile.write(read.as_text() + "\n")
+        write(read.as_text() + "\n")
     outfile.close()
-
-#function to make a dictionary for matching a barcode (exactly or with one mismatch)
-def make_barcode_dict(barcode_file, missing):
-    d = missing_dict(missing)
-    with open(barcode_file, "rt") as BCfile:
-        for line in BCfile:
-            tag,bc = line.split()
-            if bc in d:
-                print("WARNING: Barcode {} is linked with both {} and {}.".format(bc, d[bc], tag))
-                d.pop(bc)
-                continue
-            d[bc] = tag
-    return(d)
+    profiler.stop()
+
+#writer for unaligned bam output, with barcodes stored as proper BX, RX and QX tags
+#reads come in pairs (R1 then R2) and are flagged as paired, unmapped and first or second in pair
+def bam_writer(queue, outfile_name, profile_dir=None):
+    import pysam
+    profiler = Profiler(profile_dir, "bam_writer").start()
+    outfile = pysam.AlignmentFile(outfile_name, "wb", header={"HD": {"VN": "1.6", "SO": "unsorted"}})
+    get = profiler.timed("transfer", queue.get)
+    write = profiler.timed("write", outfile.write)
+    flags = [77, 141]
+    n = 0
+    while True:
+        read = get()
+        if read == None: break #for ending process
+        segment = pysam.AlignedSegment()
+        segment.query_name = read.query_name()
+        segment.query_sequence = read.seq
+        segment.query_qualities = pysam.qualitystring_to_array(read.qual)
+        segment.flag = flags[n % 2]
+        segment.set_tags([(tag, value, "Z") for tag,value in read.tags])
+        write(segment)
+        n += 1
+    outfile.close()
+    profiler.stop()
 
 #make a dictionary to return the correct barcode in the case of a mismatch
 def make_barcode_correction_dict(barcodes, missing):
@@ -126,10 +146,25 @@ parser.add_argument("--exact_match_only", help="Only allow exact barcode matches
 
 parser.add_argument("--count_barcodes", help="Output counts for all barcodes seen", action="store_true")
 
+parser.add_argument("--output_format", help="Write gzipped fastq files (barcodes in read names) or unaligned bam files (barcodes as tags)",
+                    choices=["fastq", "bam"], default="fastq")
+
+parser.add_argument("--batch_size", help="Number of read pairs to match barcodes for at once", type=int, default=10000)
+
+parser.add_argument("--profile", help="Profile the run (the main process and each writer separately) and write the profiles and a merged report to this directory")
+
 args = parser.parse_args()
 
+#time spent reading and parsing fastq records, matching barcodes, passing reads to the writers and writing, per process
+if args.profile: clear_profiles(args.profile)
+profiler = Profiler(args.profile, "main").start()
+
 ###############################################################################
 
+#bam output needs pysam, so check that we have it before starting
+if args.output_format == "bam":
+    import pysam
+
 #a dictionary of what to return for missing barcodes
 missing = dict((x, x+"00",) for x in "ABCD")
 
@@ -141,6 +176,13 @@ barcode_dicts = dict([(x, make_barcode_dict(barcode_files[x], missing = missing[
 if not args.exact_match_only:
     barcode_correction_dicts = dict([(x, make_barcode_correction_dict(list(barcode_dicts[x].keys()),
                                                                       missing="N"),) for x in "ABCD"])
+    barcode_lookups = dict([(x, make_barcode_lookup(barcode_correction_dicts[x]),) for x in "ABCD"])
+else:
+    barcode_lookups = dict([(x, make_barcode_lookup(),) for x in "ABCD"])
+
+#a single array per barcode giving the code (or missing code) for any encoded 6-mer, with correction already applied
+code_tables = dict([(x, make_tag_table(barcode_dicts[x], missing[x])[barcode_lookups[x]],) for x in "ABCD"])
+matched_tables = dict([(x, code_tables[x] != missing[x],) for x in "ABCD"])
 
 #if demultiplexing by individual, parse that file
 if args.demult_file:
@@ -163,190 +205,169 @@ read_files = [gzip.open(f, "rt") for f in args.read_files]
 writer_procs = []
 out_queues = {}
 
-#output for unassigned reads
-out_queues["unassignedR1"] = SimpleQueue()
-writer = Process(target=fastq_writer, args = (out_queues["unassignedR1"],
-                                              args.output_dir + "/" + ".".join(["unassigned", args.output_label, "R1.fastq.gz"])))
-writer.daemon = True
-writer.start()
-
-out_queues["unassignedR2"] = SimpleQueue()
-writer = Process(target=fastq_writer, args = (out_queues["unassignedR2"],
-                                              args.output_dir + "/" + ".".join(["unassigned", args.output_label, "R2.fastq.gz"])))
-writer.daemon = True
-writer.start()
-
-
-#if demultiplexing, set up output files for each individual
-if args.demult_file:
-    for sample in samples:
-        out_queues[sample] = {}
-        out_queues[sample]["R1"] = SimpleQueue()
-        writer = Process(target=fastq_writer, args = (out_queues[sample]["R1"],
-                                                      args.output_dir + "/" + ".".join([sample, args.output_label, "R1.fastq.gz"])))
+#start writers for a pair of output files (R1 and R2) and return a queue for each
+#for unaligned bam output the pair is written interleaved to a single file, so both reads go to the same queue
+def start_pair_writers(output_prefix):
+    if args.output_format == "bam":
+        queue = SimpleQueue()
+        writer = Process(target=bam_writer, args = (queue, output_prefix + ".bam", args.profile))
         writer.daemon = True
         writer.start()
         writer_procs.append(writer)
-        
-        out_queues[sample]["R2"] = SimpleQueue()
-        writer = Process(target=fastq_writer, args = (out_queues[sample]["R2"],
-                                                      args.output_dir + "/" + ".".join([sample, args.output_label, "R2.fastq.gz"])))
+        return {"R1":queue, "R2":queue}
+    queues = {}
+    for R in ["R1", "R2"]:
+        queues[R] = SimpleQueue()
+        writer = Process(target=fastq_writer, args = (queues[R], output_prefix + "." + R + ".fastq.gz", args.profile))
         writer.daemon = True
         writer.start()
         writer_procs.append(writer)
+    return queues
+
+#output for unassigned reads
+queues = start_pair_writers(args.output_dir + "/" + ".".join(["unassigned", args.output_label]))
+out_queues["unassignedR1"], out_queues["unassignedR2"] = queues["R1"], queues["R2"]
+
+#if demultiplexing, set up output files for each individual
+if args.demult_file:
+    for sample in samples:
+        out_queues[sample] = start_pair_writers(args.output_dir + "/" + ".".join([sample, args.output_label]))
         
         #and reads that can be assigned to an individual, but not to a molecule
-        out_queues[sample]["unassignedR1"] = SimpleQueue()
-        writer = Process(target=fastq_writer, args = (out_queues[sample]["unassignedR1"],
-                                                args.output_dir + "/" + ".".join([sample, "unassigned", args.output_label, "R1.fastq.gz"])))
-        writer.daemon = True
-        writer.start()
-        writer_procs.append(writer)
-
-        out_queues[sample]["unassignedR2"] = SimpleQueue()
-        writer = Process(target=fastq_writer, args = (out_queues[sample]["unassignedR2"],
-                                                args.output_dir + "/" + ".".join([sample, "unassigned", args.output_label, "R2.fastq.gz"])))
-        writer.daemon = True
-        writer.start()
-        writer_procs.append(writer)
+        queues = start_pair_writers(args.output_dir + "/" + ".".join([sample, "unassigned", args.output_label]))
+        out_queues[sample]["unassignedR1"], out_queues[sample]["unassignedR2"] = queues["R1"], queues["R2"]
 else:
     #if not demultiplexing start writers for all read 1s and read 2s
-    out_queues["R1"] = SimpleQueue()
-    writer = Process(target=fastq_writer, args = (out_queues["R1"],
-                                                  args.output_dir + "/" + ".".join([args.output_label, "R1.fastq.gz"])))
-    writer.daemon = True
-    writer.start()
-    writer_procs.append(writer)
-    
-    out_queues["R2"] = SimpleQueue()
-    writer = Process(target=fastq_writer, args = (out_queues["R2"],
-                                                  args.output_dir + "/" + ".".join([args.output_label, "R2.fastq.gz"])))
-    writer.daemon = True
-    writer.start()
-    writer_procs.append(writer)
+    queues = start_pair_writers(args.output_dir + "/" + args.output_label)
+    out_queues["R1"], out_queues["R2"] = queues["R1"], queues["R2"]
 
 
 #if counting barcodes
 if args.count_barcodes:
-    #dictionary counter that defualts to zero for new barcodes
-    barcodeCounts = dict([(x, defaultdict(int),) for x in "ABCD"])
+    #counter with a fixed size array for each barcode, indexed by the encoded barcode
+    barcodeCounts = BarcodeCounter()
     #file names for writing
     barcodeCounts_files = dict([(x, args.output_dir + "/" + args.output_label + "." + x + ".counts.txt",) for x in "ABCD"])
+    barcodeCounts_npz = args.output_dir + "/" + args.output_label + ".barcode_counts.npz"
 
 ###############################################################################
 
 
-#A loop that reads one read at a time (well, one each from R1, R2, I1 and I2
-#and determines the BX tag based on the barcodes
+#A loop that reads a batch of reads (one each from R1, R2, I1 and I2 at a time)
+#and determines the BX tags for the whole batch from the encoded barcodes
 #and then writes to either the ouput files or the unassigned files (if no match was found)
 while True:
-    I1 = get_read(index_files[0], reverse_complement=False)
-    I2 = get_read(index_files[1], reverse_complement=False)
-    R1 = get_read(read_files[0])
-    R2 = get_read(read_files[1])
-    
-    #if we're at the end of the file, just stop
-    if I1.name=="": break
+    batch = []
+    with profiler.phase("parse"):
+        while len(batch) < args.batch_size:
+            I1 = get_read(index_files[0], reverse_complement=False)
+            I2 = get_read(index_files[1], reverse_complement=False)
+            R1 = get_read(read_files[0])
+            R2 = get_read(read_files[1])
+            #if we're at the end of the file, just stop
+            if I1.name=="": break
+            batch.append((I1,I2,R1,R2,))
     
-    #extract barcodes A, B, C, D from indices
-    barcodes = {"C":I1.seq[:6], "A":I1.seq[7:], "D": I2.seq[:6], "B":I2.seq[7:]}
+    if len(batch) == 0: break
     
-    #if allowing mismatches, correct barcodes now    
-    if not args.exact_match_only:
-        for x in "ABCD":
-            barcodes[x] = barcode_correction_dicts[x][barcodes[x]]
-        #and actually reconstruct index sequence from corrected barcodes
-        I1.seq = barcodes["C"] + I1.seq[6] + barcodes["A"]
-        I2.seq = barcodes["D"] + I2.seq[6] + barcodes["B"]
+    #reads are sent to the writers once the whole batch is done, so that passing them on can be timed separately
+    outputs = []
+    with profiler.phase("compute"):
+        #extract barcodes A, B, C, D from indices as integer codes
+        I1_seqs = [reads[0].seq for reads in batch]
+        I2_seqs = [reads[1].seq for reads in batch]
+        raw_barcodes = {"C":encode_barcodes(I1_seqs, 0, 6), "A":encode_barcodes(I1_seqs, 7),
+                        "D":encode_barcodes(I2_seqs, 0, 6), "B":encode_barcodes(I2_seqs, 7)}
     
-    #if counting barcodes, add counts
-    if args.count_barcodes:
-        for x in "ABCD": barcodeCounts[x][barcodes[x]] += 1
+        #corrected barcodes (these are the raw barcodes if only allowing exact matches)
+        barcodes = dict([(x, barcode_lookups[x][raw_barcodes[x]],) for x in "ABCD"])
     
-    #Look up the codes based on the barcode sequences
-    codes = dict([(x, barcode_dicts[x][barcodes[x]],) for x in "ABCD"])
+        #if counting barcodes, add counts
+        if args.count_barcodes: barcodeCounts.add(barcodes)
     
-    #check that we got a match for each code, otherwise mark this read as unassigned
-    assigned = True
-    for x in "ABCD":
-        if codes[x] == missing[x]:
-            assigned = False
-            break
+        #Look up the codes and check that we got a match for each one, otherwise the read is unassigned
+        codes = dict([(x, code_tables[x][raw_barcodes[x]],) for x in "ABCD"])
+        assigned = matched_tables["A"][raw_barcodes["A"]] & matched_tables["B"][raw_barcodes["B"]] & \
+                   matched_tables["C"][raw_barcodes["C"]] & matched_tables["D"][raw_barcodes["D"]]
     
-    #construct the BX, RX and QX tags
-    BXtag = codes["A"] + codes["C"] + codes["B"] + codes["D"]
-    
-    RXtag = I1.seq + "+" + I2.seq
-    
-    QXtag = I1.qual + "+" + I2.qual
-    
-    name_extension = "_" + BXtag + "_" + I1.seq + "_" + revComp(I2.seq)
-    
-    #add extension and tags to read names
-    R1.name += name_extension + "\tBX:Z:"+BXtag + "\t" + "RX:Z:"+RXtag + "\t" "QX:Z:"+QXtag
-    R2.name += name_extension + "\tBX:Z:"+BXtag + "\t" + "RX:Z:"+RXtag + "\t" "QX:Z:"+QXtag
+        for i,(I1,I2,R1,R2) in enumerate(batch):
+            #if allowing mismatches, reconstruct index sequence from corrected barcodes
+            #barcodes with non-ACGT bases can't be corrected, so those are kept as they are
+            if not args.exact_match_only:
+                C = barcode_strings[barcodes["C"][i]] if barcodes["C"][i] != INVALID else I1.seq[:6]
+                A = barcode_strings[barcodes["A"][i]] if barcodes["A"][i] != INVALID else I1.seq[7:]
+                D = barcode_strings[barcodes["D"][i]] if barcodes["D"][i] != INVALID else I2.seq[:6]
+                B = barcode_strings[barcodes["B"][i]] if barcodes["B"][i] != INVALID else I2.seq[7:]
+                I1.seq = C + I1.seq[6] + A
+                I2.seq = D + I2.seq[6] + B
+        
+            #construct the BX, RX and QX tags
+            BXtag = codes["A"][i] + codes["C"][i] + codes["B"][i] + codes["D"][i]
+        
+            RXtag = I1.seq + "+" + I2.seq
+        
+            QXtag = I1.qual + "+" + I2.qual
+        
+            name_extension = "_" + BXtag + "_" + I1.seq + "_" + revComp(I2.seq)
+        
+            #add extension and tags to reads (in fastq output these are added to the read names)
+            R1.name_extension = R2.name_extension = name_extension
+            R1.tags = R2.tags = [("BX", BXtag), ("RX", RXtag), ("QX", QXtag)]
+            
+            #choose outputs
+            if args.demult_file:
+                #if demultiplexing, check individual code
+                try:
+                    sample = demult_dict[codes["C"][i]]
+                    if assigned[i]:
+                        outputs.append((out_queues[sample]["R1"], R1))
+                        outputs.append((out_queues[sample]["R2"], R2))
+                    else:
+                        #these are assignable to an sample (C tag), but not to a molecule (A, B and D)
+                        outputs.append((out_queues[sample]["unassignedR1"], R1))
+                        outputs.append((out_queues[sample]["unassignedR2"], R2))
+                except:
+                    outputs.append((out_queues["unassignedR1"], R1))
+                    outputs.append((out_queues["unassignedR2"], R2))
+            else:
+                #otherwise write to assigned or unassigned output files
+                if assigned[i]:
+                    outputs.append((out_queues["R1"], R1))
+                    outputs.append((out_queues["R2"], R2))
+                else:
+                    outputs.append((out_queues["unassignedR1"], R1))
+                    outputs.append((out_queues["unassignedR2"], R2))
     
     #write to outputs
-    if args.demult_file:
-        #if demultiplexing, check individual code
-        try:
-            sample = demult_dict[codes["C"]]
-            if assigned:
-                out_queues[sample]["R1"].put(R1)
-                out_queues[sample]["R2"].put(R2)
-            else:
-                #these are assignable to an sample (C tag), but not to a molecule (A, B and D)
-                out_queues[sample]["unassignedR1"].put(R1)
-                out_queues[sample]["unassignedR2"].put(R2)
-        except:
-            out_queues["unassignedR1"].put(R1)
-            out_queues["unassignedR2"].put(R2)
-    else:
-        #otherwise write to assigned or unassigned output files
-        if assigned:
-            out_queues["R1"].put(R1)
-            out_queues["R2"].put(R2)
-        else:
-            out_queues["unassignedR1"].put(R1)
-            out_queues["unassignedR2"].put(R2)
-
-#end writer processes
-out_queues["unassignedR1"].put(None)
-out_queues["unassignedR2"].put(None)
+    with profiler.phase("transfer"):
+        for queue, read in outputs: queue.put(read)
+
+#end writer processes (each queue only needs to be told once)
+all_queues = [out_queues["unassignedR1"], out_queues["unassignedR2"]]
 
 if args.demult_file:
     for sample in samples:
-        out_queues[sample]["R1"].put(None)
-        out_queues[sample]["R2"].put(None)
-        out_queues[sample]["unassignedR1"].put(None)
-        out_queues[sample]["unassignedR2"].put(None)
+        all_queues += [out_queues[sample][R] for R in ["R1", "R2", "unassignedR1", "unassignedR2"]]
 else:
-    out_queues["R1"].put(None)
-    out_queues["R2"].put(None)
+    all_queues += [out_queues["R1"], out_queues["R2"]]
 
+for queue in set(all_queues): queue.put(None)
 
 #close all writers to close files and clear write buffers
 for proc in writer_procs: proc.join()
 
 #if writing barcode counts
 if args.count_barcodes:
+    #the raw counts can be merged with those from other runs using merge_barcode_counts.py
+    barcodeCounts.save(barcodeCounts_npz)
     for x in "ABCD":
-        barcodeList = list(barcodeCounts[x].keys())
-        barcodeCountList = [barcodeCounts[x][b] for b in barcodeList]
-        codeList = [barcode_dicts[x][barcode] for barcode in barcodeList]
-        order = argsort(barcodeCountList)[::-1]
-        matches, mismatches = 0,0
-        with open(barcodeCounts_files[x], "wt") as BCcounts_file:
-            for i in order:
-                output = [barcodeList[i], codeList[i]]
-                if args.demult_file:
-                    try: output.append(demult_dict[codeList[i]])
-                    except: output.append("-")
-                output.append(str(barcodeCountList[i]))
-                BCcounts_file.write("\t".join(output) + "\n")
-                if codeList[i] == missing[x]: mismatches += barcodeCountList[i]
-                else: matches += barcodeCountList[i]
+        matches, mismatches = write_barcode_counts(barcodeCounts_files[x], barcodeCounts.counts[x], code_tables[x], missing[x],
+                                                   demult_dict if args.demult_file else None)
         
         print("\nBarcode " + x + ":")
         print("Matches =", matches)
         print("Misatches =", mismatches)
+
+if args.profile:
+    profiler.stop()
+    print("\nProfile report written to", merge_profiles(args.profile))
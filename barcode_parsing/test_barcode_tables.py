@@ -0,0 +1,28 @@
+#!/usr/bin/env python
+
+# ---------------------------------------------------------
+#     Tests of the barcode encoding in barcode_tables.py
+#            (run with python -m pytest)
+# ---------------------------------------------------------
+
+from barcode_tables import INVALID, barcode_strings, encode_barcodes, encode_barcode
+
+#barcodes of 13 bp index reads are encoded from positions 0-5 and 7-12
+def test_13bp_index_read():
+    seq = "ACGTAC" + "N" + "TTGCAA"
+    assert barcode_strings[encode_barcodes([seq], 0, 6)[0]] == "ACGTAC"
+    assert barcode_strings[encode_barcodes([seq], 7)[0]] == "TTGCAA"
+
+#index reads that are not 13 bp give barcodes that are not 6 bp, which can't be matched
+def test_non_13bp_index_read():
+    seqs = ["ACGTAC" + "N" + "TTGCAAG", "ACGTAC" + "N" + "TTGCA", "ACGTAC" + "N" + "TTGCAA"]
+    codes = encode_barcodes(seqs, 7)
+    assert codes[0] == INVALID
+    assert codes[1] == INVALID
+    assert codes[2] == encode_barcode("TTGCAA")
+    assert list(encode_barcodes(["ACGTA"], 0, 6)) == [INVALID]
+
+#sequences with anything other than ACGT are invalid
+def test_non_acgt_barcode():
+    assert encode_barcode("ACGNAC") == INVALID
+    assert encode_barcode("ACGTACG") == INVALID
@@ -0,0 +1,243 @@
+#!/usr/bin/env python
+# Description: This script makes a synthetic haplotagging data set: a reference chromosome, mapped reads of each sample with
+#              their barcodes (bam and barcode bed files, as made by wrath) and raw haplotag fastq files (for parse_haptag_barcodes.py).
+#              Reads come from long molecules sampled from a genome with the given inversions, so reads of molecules that span
+#              an inversion breakpoint link distant windows
+# Usage: python make_synthetic_data.py -o output_dir -l chromosome_length -m molecule_length -n barcodes [-i start-end ...]
+# Output: output_dir/reference.fa (and .fai)
+#         output_dir/<sample>.bam (and .bai), one per sample, with barcodes in the BX tag
+#         output_dir/barcodes.bed.gz (and .tbi), barcodes of all samples as made by wrath's getbarcodes step
+#         output_dir/windows_<window_size>.bed, windows as made by wrath's makewindows step
+#         output_dir/samples.txt, list of bam files
+#         output_dir/R1.fq.gz, R2.fq.gz, I1.fq.gz, I2.fq.gz, haplotag read and index files
+#         output_dir/inversions.csv, planted inversions, and outliers.csv, the matrix cells linking their breakpoints
+#         (in the format of outlier_detection.R, for the SV detection scripts)
+# Modules required: argparse, os, sys, gzip, json, pysam, numpy
+#########################################################################################################################
+
+import argparse, os, sys, gzip, json, pysam
+import numpy as np
+
+#barcode files used by parse_haptag_barcodes.py
+barcodeDir = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "barcode_parsing")
+
+complementTrans = str.maketrans("ACGT", "TGCA")
+
+
+#########################################################################################################################
+
+#functions
+
+'''Barcode codes and sequences (e.g. A01 ACGGAA) of one of the barcode files'''
+def read_barcode_file(barcodeFile):
+    with open(barcodeFile, "rt") as bcFile:
+        return [line.split() for line in bcFile if line.strip()]
+
+'''Random reference sequence'''
+def make_reference(rng, length):
+    return "".join(np.array(list("ACGT"))[rng.integers(0, 4, size=length)])
+
+'''Position in the reference of positions of the sampled genome, where each inversion (start, end) is reversed'''
+def sample_to_reference(positions, inversions):
+    positions = positions.copy()
+    reverse = np.zeros(positions.size, dtype=bool)
+    for start, end in inversions:
+        inside = (positions >= start) & (positions < end)
+        positions[inside] = start + end - 1 - positions[inside]
+        reverse[inside] = True
+    return positions, reverse
+
+'''Reads of one sample: molecules of exponentially distributed length are placed at random along the chromosome, each
+with a barcode (barcodes are reused for moleculesPerBarcode molecules, as in real libraries), and reads are placed at
+random along each molecule with one read every readSpacing bp on average. Returns 0-based reference positions, strands
+and barcode numbers of the reads, sorted by position.'''
+def simulate_reads(rng, chromLength, nBarcodes, moleculesPerBarcode, moleculeLength, readSpacing, readLength, inversions):
+    nMolecules = nBarcodes * moleculesPerBarcode
+    lengths = np.maximum(readLength, rng.exponential(moleculeLength, size=nMolecules).astype(np.int64))
+    starts = rng.integers(0, max(1, chromLength - readLength), size=nMolecules)
+    ends = np.minimum(starts + lengths, chromLength - readLength)
+    nReads = rng.poisson(np.maximum(1, (ends - starts) / readSpacing))
+    molecule = np.repeat(np.arange(nMolecules), nReads)
+    positions = starts[molecule] + (rng.random(molecule.size) * (ends - starts)[molecule]).astype(np.int64)
+    positions, reverse = sample_to_reference(positions, inversions)
+    positions = np.clip(positions, 0, chromLength - readLength)
+    barcodes = molecule % nBarcodes
+    order = np.argsort(positions, kind="stable")
+    return positions[order], reverse[order], barcodes[order]
+
+'''Barcode names (as in the BX tag) of nBarcodes barcodes of a sample, all with the C code of the sample'''
+def sample_barcode_names(rng, nBarcodes, sampleNumber, barcodeCodes):
+    combinations = rng.choice(len(barcodeCodes["A"]) * len(barcodeCodes["B"]) * len(barcodeCodes["D"]), size=nBarcodes, replace=False)
+    a, rest = np.divmod(combinations, len(barcodeCodes["B"]) * len(barcodeCodes["D"]))
+    b, d = np.divmod(rest, len(barcodeCodes["D"]))
+    c = barcodeCodes["C"][sampleNumber % len(barcodeCodes["C"])][0]
+    return [barcodeCodes["A"][i][0] + c + barcodeCodes["B"][j][0] + barcodeCodes["D"][k][0] for i, j, k in zip(a, b, d)]
+
+def write_reference(fileName, chromosome, sequence):
+    with open(fileName, "wt") as fasta:
+        fasta.write(">" + chromosome + "\n")
+        for i in range(0, len(sequence), 60):
+            fasta.write(sequence[i:i+60] + "\n")
+    pysam.faidx(fileName)
+
+'''Write the reads of a sample as a sorted and indexed bam file, with mapping quality 60 and the barcode in the BX tag'''
+def write_bam(fileName, chromosome, sequence, positions, reverse, barcodes, barcodeNames, readLength):
+    header = {"HD": {"VN": "1.6", "SO": "coordinate"}, "SQ": [{"SN": chromosome, "LN": len(sequence)}]}
+    qualities = pysam.qualitystring_to_array("F" * readLength)
+    with pysam.AlignmentFile(fileName, "wb", header=header) as bam:
+        for n, (position, isReverse, barcode) in enumerate(zip(positions, reverse, barcodes)):
+            read = pysam.AlignedSegment()
+            read.query_name = "read{}".format(n)
+            read.flag = 16 if isReverse else 0
+            read.reference_id = 0
+            read.reference_start = int(position)
+            read.mapping_quality = 60
+            read.cigarstring = "{}M".format(readLength)
+            read.query_sequence = sequence[position:position+readLength]
+            read.query_qualities = qualities
+            read.set_tag("BX", barcodeNames[barcode], "Z")
+            bam.write(read)
+    pysam.index(fileName)
+
+'''Barcode bed lines of a sample, as written by get_barcodes.py'''
+def barcode_bed_lines(chromosome, positions, barcodes, barcodeNames, sample):
+    return [(int(position) + 1, "\t".join([chromosome, str(position + 1), str(position + 1), "BX:Z:" + barcodeNames[barcode], sample]))
+            for position, barcode in zip(positions, barcodes)]
+
+'''Write barcode bed lines sorted by position, compressed and tabix indexed'''
+def write_barcode_bed(fileName, bedLines):
+    bedLines.sort(key=lambda line: line[0])
+    with open(fileName, "wt") as bed:
+        for position, line in bedLines:
+            bed.write(line + "\n")
+    pysam.tabix_index(fileName, preset="bed", force=True)
+    return fileName + ".gz"
+
+'''Windows of a chromosome, as made by bedtools makewindows'''
+def write_windows(fileName, chromosome, chromLength, winSize):
+    with open(fileName, "wt") as bed:
+        for start in range(0, chromLength, winSize):
+            bed.write("{}\t{}\t{}\n".format(chromosome, start, min(start + winSize, chromLength)))
+    return (chromLength + winSize - 1) // winSize
+
+'''Matrix cells (1-based rows and columns, as written by outlier_detection.R) linking the windows around the two
+breakpoints of each inversion, so that the SV detection scripts can be run without R'''
+def write_planted_outliers(fileName, inversions, winSize, nWindows):
+    with open(fileName, "wt") as outliers:
+        outliers.write("nrow,ncol,value,Estimate,Est.Error,Q2.5,Q97.5,upper,lower,z_score\n")
+        for start, end in inversions:
+            for row in range(start // winSize - 1, start // winSize + 2):
+                for col in range(end // winSize - 1, end // winSize + 2):
+                    if 0 <= row < col < nWindows:
+                        outliers.write("{},{},0.1,0,0,0,0,TRUE,FALSE,3\n".format(row + 1, col + 1))
+
+'''Add a substitution at each base with probability errorRate'''
+def add_errors(rng, sequence, errorRate):
+    if errorRate <= 0: return sequence
+    bases = np.array(list(sequence))
+    errors = rng.random(bases.size) < errorRate
+    bases[errors] = np.array(list("ACGT"))[rng.integers(0, 4, size=errors.sum())]
+    return "".join(bases)
+
+'''Raw haplotag reads: index read 1 is CCCCCCNAAAAAA and index read 2 DDDDDDNBBBBBB (see barcode_parsing/README.md),
+and the sequencing reads are taken from the reference'''
+def write_haplotag_fastqs(rng, outDir, nPairs, sequence, barcodeCodes, nSamples, readLength, errorRate):
+    files = [gzip.open(os.path.join(outDir, name), "wt", compresslevel=1) for name in ["R1.fq.gz", "R2.fq.gz", "I1.fq.gz", "I2.fq.gz"]]
+    chosen = dict((x, rng.integers(0, len(barcodeCodes[x]), size=nPairs),) for x in "ABD")
+    chosen["C"] = rng.integers(0, min(nSamples, len(barcodeCodes["C"])), size=nPairs)
+    positions = rng.integers(0, len(sequence) - 2 * readLength, size=nPairs)
+    for n in range(nPairs):
+        bc = dict((x, barcodeCodes[x][chosen[x][n]][1],) for x in "ABCD")
+        I1 = add_errors(rng, bc["C"] + "A" + bc["A"], errorRate)
+        I2 = add_errors(rng, bc["D"] + "A" + bc["B"], errorRate)
+        R1 = sequence[positions[n]:positions[n]+readLength]
+        R2 = sequence[positions[n]+readLength:positions[n]+2*readLength].translate(complementTrans)[::-1]
+        for fileNumber, (seq, read) in enumerate(zip([R1, R2, I1, I2], [1, 2, 1, 2])):
+            files[fileNumber].write("@read{} {}:N:0\n{}\n+\n{}\n".format(n, read, seq, "F" * len(seq)))
+    for f in files: f.close()
+
+'''Make the whole data set and return a summary of it (file names and sizes)'''
+def make_dataset(outDir, chromLength=1000000, winSize=10000, nSamples=2, nBarcodes=2000, moleculesPerBarcode=2,
+                 moleculeLength=50000, readSpacing=2000, readLength=100, inversions=(), fastqPairs=10000, errorRate=0.005,
+                 seed=1, chromosome="chr1"):
+    os.makedirs(outDir, exist_ok=True)
+    rng = np.random.default_rng(seed)
+    barcodeCodes = dict((x, read_barcode_file(os.path.join(barcodeDir, "BC_" + x + ".txt")),) for x in "ABCD")
+    sequence = make_reference(rng, chromLength)
+    write_reference(os.path.join(outDir, "reference.fa"), chromosome, sequence)
+
+    bamFiles = []
+    bedLines = []
+    nReads = 0
+    for sampleNumber in range(nSamples):
+        sample = "sample{}".format(sampleNumber)
+        barcodeNames = sample_barcode_names(rng, nBarcodes, sampleNumber, barcodeCodes)
+        positions, reverse, barcodes = simulate_reads(rng, chromLength, nBarcodes, moleculesPerBarcode, moleculeLength,
+                                                      readSpacing, readLength, inversions)
+        bamFiles.append(os.path.join(outDir, sample + ".bam"))
+        write_bam(bamFiles[-1], chromosome, sequence, positions, reverse, barcodes, barcodeNames, readLength)
+        bedLines += barcode_bed_lines(chromosome, positions, barcodes, barcodeNames, sample)
+        nReads += positions.size
+    barcodeFile = write_barcode_bed(os.path.join(outDir, "barcodes.bed"), bedLines)
+
+    with open(os.path.join(outDir, "samples.txt"), "wt") as samplesFile:
+        samplesFile.write("\n".join(bamFiles) + "\n")
+    windowFile = os.path.join(outDir, "windows_{}.bed".format(winSize))
+    nWindows = write_windows(windowFile, chromosome, chromLength, winSize)
+    with open(os.path.join(outDir, "inversions.csv"), "wt") as inversionsFile:
+        inversionsFile.write("start,end\n" + "".join("{},{}\n".format(start, end) for start, end in inversions))
+    write_planted_outliers(os.path.join(outDir, "outliers.csv"), inversions, winSize, nWindows)
+    if fastqPairs > 0:
+        write_haplotag_fastqs(rng, outDir, fastqPairs, sequence, barcodeCodes, nSamples, readLength, errorRate)
+
+    return {"chromosome": chromosome, "chrom_length": chromLength, "window_size": winSize, "windows": nWindows,
+            "samples": nSamples, "barcodes": nBarcodes * nSamples, "reads": nReads, "fastq_pairs": fastqPairs,
+            "inversions": [list(inversion) for inversion in inversions], "reference": os.path.join(outDir, "reference.fa"),
+            "bams": bamFiles, "samples_file": os.path.join(outDir, "samples.txt"), "barcode_file": barcodeFile,
+            "window_file": windowFile, "outliers_file": os.path.join(outDir, "outliers.csv"),
+            "fastqs": [os.path.join(outDir, name) for name in ["R1.fq.gz", "R2.fq.gz", "I1.fq.gz", "I2.fq.gz"]]}
+
+'''Parse an inversion given as start-end'''
+def inversion(text):
+    start, end = text.split("-")
+    return int(start), int(end)
+
+
+#########################################################################################################################
+
+if __name__ == "__main__":
+
+    ### parse arguments
+
+    parser = argparse.ArgumentParser()
+
+    parser.add_argument("-o", "--outDir", help="Output directory", action = "store", required = True)
+
+    #genome and molecules
+    parser.add_argument("-l", "--chromLength", help="Chromosome length", type=int, action = "store", default = 1000000)
+    parser.add_argument("-w", "--winSize", help="Window size", type=int, action = "store", default = 10000)
+    parser.add_argument("-i", "--inversions", help="Inversions to plant, as start-end", type=inversion, nargs = "*", action = "store", default = [])
+    parser.add_argument("-s", "--samples", help="Number of samples", type=int, action = "store", default = 2)
+    parser.add_argument("-n", "--barcodes", help="Number of barcodes of each sample", type=int, action = "store", default = 2000)
+    parser.add_argument("--moleculesPerBarcode", help="Number of molecules tagged with each barcode", type=int, action = "store", default = 2)
+    parser.add_argument("-m", "--moleculeLength", help="Mean molecule length", type=int, action = "store", default = 50000)
+    parser.add_argument("--readSpacing", help="Mean distance between reads of a molecule", type=int, action = "store", default = 2000)
+    parser.add_argument("--readLength", help="Read length", type=int, action = "store", default = 100)
+
+    #raw reads
+    parser.add_argument("-f", "--fastqPairs", help="Number of raw haplotag read pairs (0 for none)", type=int, action = "store", default = 10000)
+    parser.add_argument("-e", "--errorRate", help="Sequencing error rate of index reads", type=float, action = "store", default = 0.005)
+
+    parser.add_argument("--seed", help="Random seed", type=int, action = "store", default = 1)
+
+    args = parser.parse_args()
+
+    for start, end in args.inversions:
+        if not 0 <= start < end <= args.chromLength:
+            sys.exit("Inversion {}-{} is not within the chromosome".format(start, end))
+
+    summary = make_dataset(args.outDir, args.chromLength, args.winSize, args.samples, args.barcodes, args.moleculesPerBarcode,
+                           args.moleculeLength, args.readSpacing, args.readLength, args.inversions, args.fastqPairs,
+                           args.errorRate, args.seed)
+    json.dump(summary, sys.stdout, indent=2)
+    sys.stdout.write("\n")
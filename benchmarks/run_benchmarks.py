@@ -0,0 +1,204 @@
+#!/usr/bin/env python
+# Description: This script makes synthetic data sets of several sizes (with make_synthetic_data.py) and times the wrath
+#              scripts on them with several numbers of threads, reporting wall and CPU time, peak memory and throughput as json.
+#              If a previous report is given, stages that got slower or use more memory than a tolerance are reported and
+#              the script exits with an error, so that regressions are caught
+# Usage: python run_benchmarks.py -o report.json [-l chromosome_lengths] [-t threads] [-b baseline.json]
+# Output: report.json = one result per stage, data set size and number of threads
+# Modules required: argparse, os, sys, json, time, shutil, platform, subprocess, tempfile, numpy, pysam
+#########################################################################################################################
+
+import argparse, os, sys, json, time, shutil, platform, subprocess, tempfile
+
+from make_synthetic_data import make_dataset
+
+#scripts are run from the repository
+repoDir = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..")
+svDir = os.path.join(repoDir, "sv_detection")
+parsingDir = os.path.join(repoDir, "barcode_parsing")
+
+
+#########################################################################################################################
+
+### parse arguments
+
+parser = argparse.ArgumentParser()
+
+parser.add_argument("-o", "--outFile", help="Output json report", action = "store", default = "benchmark_report.json")
+parser.add_argument("-d", "--workDir", help="Directory for the synthetic data (a temporary one by default, which is removed)", action = "store")
+
+#data sets
+parser.add_argument("-l", "--chromLengths", help="Chromosome length of each data set", type=int, nargs = "+", action = "store", default = [500000, 1000000, 2000000])
+parser.add_argument("-w", "--winSize", help="Window size", type=int, action = "store", default = 10000)
+parser.add_argument("-s", "--samples", help="Number of samples", type=int, action = "store", default = 2)
+parser.add_argument("-n", "--barcodesPerMb", help="Number of barcodes of each sample per Mb of chromosome", type=int, action = "store", default = 4000)
+parser.add_argument("-m", "--moleculeLength", help="Mean molecule length", type=int, action = "store", default = 50000)
+parser.add_argument("-f", "--fastqPairsPerMb", help="Number of raw haplotag read pairs per Mb of chromosome", type=int, action = "store", default = 20000)
+parser.add_argument("--seed", help="Random seed", type=int, action = "store", default = 1)
+
+#runs
+parser.add_argument("-t", "--threads", help="Numbers of threads to time the matrix with", type=int, nargs = "+", action = "store", default = [1, 2, 4])
+parser.add_argument("--stages", help="Stages to run (default: all)", nargs = "+", action = "store",
+                    choices = ["parse", "matrix", "index", "matrix_index", "wrath", "outliers", "sv", "sv_plot", "plot"])
+
+#regressions
+parser.add_argument("-b", "--baseline", help="Previous report to compare with", action = "store")
+parser.add_argument("--tolerance", help="Allowed relative increase in wall time and peak memory over the baseline", type=float, action = "store", default = 0.25)
+
+args = parser.parse_args()
+
+
+#########################################################################################################################
+
+#functions
+
+'''Run a command and measure it. The resource usage of the process (and the processes it waited for) is taken from wait4,
+so the peak memory is that of this run only.'''
+def run_command(command, cwd):
+    startTime = time.time()
+    with open(os.path.join(cwd, "benchmark.log"), "at") as log:
+        log.write("\n$ " + " ".join(command) + "\n")
+        log.flush()
+        process = subprocess.Popen(command, cwd=cwd, stdout=log, stderr=log)
+        pid, status, usage = os.wait4(process.pid, 0)
+        process.returncode = os.waitstatus_to_exitcode(status)
+    wall = time.time() - startTime
+    return {"wall_s": round(wall, 3), "user_s": round(usage.ru_utime, 3), "sys_s": round(usage.ru_stime, 3),
+            "peak_rss_mb": round(usage.ru_maxrss / 1024, 1), "returncode": process.returncode}
+
+'''Time a stage, with its throughput in items (e.g. windows or read pairs) per second'''
+def benchmark(results, stage, command, cwd, dataset, threads, items, unit):
+    result = {"stage": stage, "chrom_length": dataset["chrom_length"], "windows": dataset["windows"],
+              "reads": dataset["reads"], "threads": threads}
+    result.update(run_command(command, cwd))
+    result["throughput"] = round(items / result["wall_s"], 1) if result["wall_s"] > 0 else None
+    result["throughput_unit"] = unit
+    results.append(result)
+    sys.stderr.write("{stage:>12} {chrom_length:>10} bp {threads:>3} threads: {wall_s:>8.2f} s {peak_rss_mb:>8.1f} Mb {throughput} {throughput_unit}\n".format(**result))
+    if result["returncode"] != 0:
+        sys.stderr.write("  failed, see {}\n".format(os.path.join(cwd, "benchmark.log")))
+    return result
+
+'''Key that identifies the same run in two reports'''
+def result_key(result):
+    return (result["stage"], result["chrom_length"], result["threads"])
+
+'''Runs that are slower or use more memory than in the baseline by more than the tolerance'''
+def find_regressions(results, baselineResults, tolerance):
+    baseline = dict((result_key(result), result) for result in baselineResults)
+    regressions = []
+    for result in results:
+        old = baseline.get(result_key(result))
+        if old is None or old["returncode"] != 0: continue
+        for measure in ["wall_s", "peak_rss_mb"]:
+            if result[measure] > old[measure] * (1 + tolerance):
+                regressions.append({"stage": result["stage"], "chrom_length": result["chrom_length"], "threads": result["threads"],
+                                    "measure": measure, "baseline": old[measure], "value": result[measure]})
+    return regressions
+
+
+#########################################################################################################################
+
+stages = set(args.stages) if args.stages else set(["parse", "matrix", "index", "matrix_index", "wrath", "outliers", "sv", "sv_plot", "plot"])
+workDir = args.workDir if args.workDir else tempfile.mkdtemp(prefix="wrath_benchmark_")
+python = sys.executable
+results = []
+datasets = []
+
+for chromLength in args.chromLengths:
+    dataDir = os.path.abspath(os.path.join(workDir, "chr_{}".format(chromLength)))
+    #plant one inversion in the middle of each chromosome
+    inversions = [(chromLength * 2 // 5, chromLength * 3 // 5)]
+    sys.stderr.write("\nMaking data set with a {} bp chromosome in {}\n".format(chromLength, dataDir))
+    startTime = time.time()
+    dataset = make_dataset(dataDir, chromLength, args.winSize, args.samples, args.barcodesPerMb * chromLength // 1000000,
+                           moleculeLength=args.moleculeLength, inversions=inversions,
+                           fastqPairs=(args.fastqPairsPerMb * chromLength // 1000000) if "parse" in stages else 0, seed=args.seed)
+    dataset["generation_s"] = round(time.time() - startTime, 3)
+    datasets.append(dataset)
+    nWindows = dataset["windows"]
+
+    if "parse" in stages:
+        benchmark(results, "parse", [python, os.path.join(parsingDir, "parse_haptag_barcodes.py"), "-R"] + dataset["fastqs"][:2] +
+                  ["-I"] + dataset["fastqs"][2:] + ["--output_label", "parsed", "--output_dir", dataDir, "--count_barcodes",
+                  "--barcode_files"] + [os.path.join(parsingDir, "BC_" + x + ".txt") for x in "ABCD"],
+                  dataDir, dataset, 1, dataset["fastq_pairs"], "read_pairs/s")
+
+    #matrix from the barcode bed file and from a barcode index, with each number of threads
+    matrixFile = os.path.join(dataDir, "matrix.txt")
+    for threads in args.threads:
+        if "matrix" in stages:
+            benchmark(results, "matrix", [python, os.path.join(svDir, "jaccard_matrix_simplequeue.py"), "-w", dataset["window_file"],
+                      "-b", dataset["barcode_file"], "-o", matrixFile, "-t", str(threads)],
+                      dataDir, dataset, threads, nWindows * (nWindows + 1) / 2, "window_pairs/s")
+    indexDir = os.path.join(dataDir, "barcodes.index")
+    if "index" in stages or "matrix_index" in stages:
+        benchmark(results, "index", [python, os.path.join(svDir, "make_barcode_index.py"), "-w", dataset["window_file"],
+                  "-b", dataset["barcode_file"], "-o", indexDir], dataDir, dataset, 1, dataset["reads"], "reads/s")
+    for threads in args.threads:
+        if "matrix_index" in stages:
+            benchmark(results, "matrix_index", [python, os.path.join(svDir, "jaccard_matrix_simplequeue.py"), "-w", dataset["window_file"],
+                      "-i", indexDir, "-o", matrixFile, "-t", str(threads)],
+                      dataDir, dataset, threads, nWindows * (nWindows + 1) / 2, "window_pairs/s")
+
+    #the wrath driver from the bam files to the matrix (without plotting), in its own directory for each number of threads,
+    #with the metrics it logs for each of its stages
+    for threads in args.threads:
+        if "wrath" in stages:
+            wrathDir = os.path.join(dataDir, "wrath_{}".format(threads))
+            shutil.rmtree(wrathDir, ignore_errors=True)
+            os.makedirs(wrathDir)
+            result = benchmark(results, "wrath", [python, os.path.join(repoDir, "wrath"), "-g", dataset["reference"], "-c", dataset["chromosome"],
+                               "-w", str(args.winSize), "-a", dataset["samples_file"], "-t", str(threads), "-p"],
+                               wrathDir, dataset, threads, nWindows * (nWindows + 1) / 2, "window_pairs/s")
+            metricsFile = os.path.join(wrathDir, "wrath_out", "metrics_{}.jsonl".format(dataset["chromosome"]))
+            if os.path.exists(metricsFile):
+                with open(metricsFile, "rt") as metrics:
+                    result["stages"] = [json.loads(line) for line in metrics if line.strip()]
+
+    #the later stages need the matrix without the trailing commas (as edited by wrath)
+    if not os.path.exists(matrixFile): continue
+    with open(matrixFile, "rt") as matrix:
+        lines = [line.rstrip("\n").rstrip(",") for line in matrix]
+    with open(matrixFile, "wt") as matrix:
+        matrix.write("\n".join(lines) + "\n")
+
+    #outliers are detected with R if it is available, otherwise the cells linking the planted breakpoints are used
+    outliersFile = dataset["outliers_file"]
+    if "outliers" in stages and shutil.which("Rscript"):
+        result = benchmark(results, "outliers", ["Rscript", os.path.join(svDir, "outlier_detection.R"), matrixFile,
+                           os.path.join(dataDir, "detected_outliers")], dataDir, dataset, 1, nWindows, "windows/s")
+        if result["returncode"] == 0: outliersFile = os.path.join(dataDir, "detected_outliers.csv")
+
+    if "sv" in stages:
+        benchmark(results, "sv", [python, os.path.join(svDir, "sv_detection.py"), "-m", matrixFile,
+                  "-o", outliersFile, "-s", os.path.join(dataDir, "svs.txt"), "-f", str(args.winSize)],
+                  dataDir, dataset, 1, nWindows, "windows/s")
+    if "sv_plot" in stages:
+        benchmark(results, "sv_plot", [python, os.path.join(svDir, "sv_detection_and_heatmap.py"), "-m", matrixFile,
+                  "-w", dataset["window_file"], "-o", outliersFile, "-p", os.path.join(dataDir, "sv_heatmap.png"),
+                  "-s", os.path.join(dataDir, "svs_plot.txt"), "-f", str(args.winSize), "-c", dataset["chromosome"]],
+                  dataDir, dataset, 1, nWindows, "windows/s")
+    if "plot" in stages:
+        benchmark(results, "plot", [python, os.path.join(svDir, "plot_heatmap.py"), "-m", matrixFile, "-w", dataset["window_file"],
+                  "-o", os.path.join(dataDir, "heatmap.png")], dataDir, dataset, 1, nWindows, "windows/s")
+
+report = {"system": {"python": platform.python_version(), "platform": platform.platform(), "cpus": os.cpu_count()},
+          "settings": vars(args), "datasets": datasets, "results": results}
+
+if args.baseline:
+    with open(args.baseline, "rt") as baselineFile:
+        report["regressions"] = find_regressions(results, json.load(baselineFile)["results"], args.tolerance)
+    for regression in report["regressions"]:
+        sys.stderr.write("Regression: {stage} ({chrom_length} bp, {threads} threads) {measure} {baseline} -> {value}\n".format(**regression))
+
+with open(args.outFile, "wt") as outFile:
+    json.dump(report, outFile, indent=2)
+    outFile.write("\n")
+
+if not args.workDir:
+    shutil.rmtree(workDir)
+
+failed = [result for result in results if result["returncode"] != 0]
+if failed or report.get("regressions"):
+    sys.exit(1)
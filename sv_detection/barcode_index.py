@@ -0,0 +1,164 @@
+#!/usr/bin/env python
+# Description: Binary index of the barcodes in each genomic window of each sample, so that they don't need to be read from the barcode bed file again
+# Usage: from barcode_index import build_barcode_index, write_barcode_index, index_matches, BarcodeIndex
+# Input: barcode_file = tabix indexed barcode bed file (as made by wrath)
+#        windows = data frame with genomic window positions
+# Output: index_dir = directory with one uncompressed numpy array per file, which are memory-mapped when read:
+#           barcodeNames.npy  barcode names (e.g. BX:Z:A01C01B01D01), the id of a barcode is its position here
+#           samples.npy       sample names (from the fifth column of the barcode file, or "" if there is none)
+#           chromosomes.npy, starts.npy, ends.npy  window positions
+#           offsets.npy       start of the barcodes of window w and sample s in barcodes.npy is offsets[w * nSamples + s]
+#           barcodes.npy      sorted unique barcode ids of each window and sample, one after the other
+#           counts.npy        number of reads of each of these barcodes
+# Modules required: os, shutil, pysam, numpy
+#########################################################################################################################
+
+import os, shutil, pysam
+import numpy as np
+
+from window_barcodes import window_positions
+
+
+#########################################################################################################################
+
+'''Read the barcodes of all windows for each sample from a barcode file. Each chromosome is read once, and the reads of
+each window taken from it, so windows may overlap. As tabix does with the barcode file (where each read is a zero length
+interval at its position p), a read is in a window if start < p < end.'''
+def build_barcode_index(inFile, windows):
+    barcodeIds = {}
+    sampleIds = {}
+    windowKeys = [None] * windows.shape[0]
+    windowCounts = [None] * windows.shape[0]
+    for chromosome, chromWindows in windows.groupby(0, sort=False):
+        windowStarts = chromWindows[1].to_numpy(dtype=np.int64)
+        windowEnds = chromWindows[2].to_numpy(dtype=np.int64)
+        positions = []
+        localIds = {}
+        localCodes = []
+        samples = []
+        for rowbed in inFile.fetch(chromosome, int(windowStarts.min()), int(windowEnds.max()), parser=pysam.asTuple()):
+            positions.append(int(rowbed[1]))
+            localCodes.append(localIds.setdefault(rowbed[3], len(localIds)))
+            samples.append(sampleIds.setdefault(rowbed[4] if len(rowbed) > 4 else "", len(sampleIds)))
+        positions = np.array(positions, dtype=np.int64)
+        localCodes = np.array(localCodes, dtype=np.int64)
+        samples = np.array(samples, dtype=np.int64)
+        localNames = list(localIds.keys())
+        localToGlobal = np.full(len(localNames), -1, dtype=np.int64)
+        first = np.searchsorted(positions, windowStarts, side="right")
+        last = np.searchsorted(positions, windowEnds, side="left")
+        for windowNumber, start, end in zip(np.flatnonzero((windows[0] == chromosome).to_numpy()), first, last):
+            #barcodes get ids in the order they are first found in the windows, as in read_window_barcodes
+            codes, firstRead = np.unique(localCodes[start:end], return_index=True)
+            for code in codes[np.argsort(firstRead)]:
+                if localToGlobal[code] < 0: localToGlobal[code] = barcodeIds.setdefault(localNames[code], len(barcodeIds))
+            ids = localToGlobal[localCodes[start:end]]
+            #barcodes are sorted by sample and then by id, as keys combining both
+            windowKeys[windowNumber], windowCounts[windowNumber] = np.unique(samples[start:end] * (2**32) + ids, return_counts=True)
+    return list(barcodeIds.keys()), list(sampleIds.keys()), windowKeys, windowCounts
+
+
+'''Write the barcodes read with build_barcode_index to an index directory. The index is written to a temporary directory that
+then replaces indexDir, so an interrupted run doesn't leave a partial index behind.'''
+def write_barcode_index(indexDir, barcodeNames, sampleNames, windowKeys, windowCounts, windows):
+    tmpDir = indexDir.rstrip("/") + ".tmp"
+    shutil.rmtree(tmpDir, ignore_errors=True)
+    os.makedirs(tmpDir)
+    nSamples = len(sampleNames)
+    keys = np.concatenate(windowKeys + [np.zeros(0, dtype=np.int64)])
+    #number of barcodes of each sample in each window, in the order they are stored
+    sampleSizes = np.array([np.bincount(windowKey // (2**32), minlength=nSamples) for windowKey in windowKeys], dtype=np.int64).reshape(-1)
+    offsets = np.zeros(sampleSizes.size + 1, dtype=np.int64)
+    offsets[1:] = np.cumsum(sampleSizes)
+    chromosomes, starts, ends = window_positions(windows)
+    arrays = {"barcodeNames": np.array(barcodeNames, dtype=str), "samples": np.array(sampleNames, dtype=str),
+              "chromosomes": chromosomes, "starts": starts, "ends": ends, "offsets": offsets,
+              "barcodes": (keys % (2**32)).astype(np.int32),
+              "counts": np.concatenate(windowCounts + [np.zeros(0, dtype=np.int64)]).astype(np.int32)}
+    for name, array in arrays.items():
+        np.save(os.path.join(tmpDir, name + ".npy"), array)
+    shutil.rmtree(indexDir, ignore_errors=True)
+    os.rename(tmpDir, indexDir)
+
+
+'''Whether there is a readable barcode index in indexDir made for these windows (and with all the given samples). Missing,
+partial or damaged indices (e.g. from an interrupted run of an older version) are treated as no index.'''
+def index_matches(indexDir, windows, samples=None):
+    if not os.path.isdir(indexDir): return False
+    try:
+        index = BarcodeIndex(indexDir)
+        return index.matches(windows) and (samples is None or set(samples) <= set(index.samples))
+    except (OSError, ValueError, EOFError): return False
+
+
+'''Barcode index written by write_barcode_index. Arrays are memory-mapped, so opening an index is quick and only the
+windows that are used are read from disk.'''
+class BarcodeIndex:
+    def __init__(self, indexDir):
+        def load(name): return np.load(os.path.join(indexDir, name + ".npy"), mmap_mode="r")
+        self.indexDir = indexDir
+        self.barcodeNamesArray = load("barcodeNames")
+        self.samples = [str(sample) for sample in load("samples")]
+        self.chromosomes = load("chromosomes")
+        self.starts = load("starts")
+        self.ends = load("ends")
+        self.offsets = load("offsets")
+        self.barcodes = load("barcodes")
+        self.counts = load("counts")
+        self.nWindows = self.starts.shape[0]
+
+    #barcode names, in id order, as given by read_window_barcodes
+    def barcode_names(self):
+        return [str(name) for name in self.barcodeNamesArray]
+
+    #whether the index was made for these windows
+    def matches(self, windows):
+        chromosomes, starts, ends = window_positions(windows)
+        return (np.array_equal(self.chromosomes, chromosomes) and np.array_equal(self.starts, starts)
+                and np.array_equal(self.ends, ends))
+
+    #numbers of the windows overlapping a region of a chromosome
+    def region_windows(self, chromosome, start, end):
+        return np.flatnonzero((self.chromosomes == chromosome) & (self.starts < end) & (self.ends > start))
+
+    #numbers of the given samples (all of them by default) in the index. Samples that are not in it (e.g. misspelled in a
+    #group file) raise a KeyError that names them, instead of being left out
+    def sample_numbers(self, samples=None):
+        if samples is None: return range(len(self.samples))
+        unknown = [sample for sample in samples if sample not in self.samples]
+        if len(unknown) > 0:
+            raise KeyError("Samples not in the barcode index {}: {}".format(self.indexDir, ", ".join(unknown)))
+        return [self.samples.index(sample) for sample in samples]
+
+    #barcodes of the given samples (all of them by default) in a window, with their number of reads
+    def window(self, windowNumber, samples=None):
+        nSamples = len(self.samples)
+        sampleNumbers = self.sample_numbers(samples)
+        slices = [slice(self.offsets[windowNumber * nSamples + s], self.offsets[windowNumber * nSamples + s + 1]) for s in sampleNumbers]
+        if len(slices) == 1:
+            return np.asarray(self.barcodes[slices[0]], dtype=np.int64), np.asarray(self.counts[slices[0]], dtype=np.int64)
+        barcodes = np.concatenate([self.barcodes[s] for s in slices] + [np.zeros(0, dtype=np.int32)]).astype(np.int64)
+        counts = np.concatenate([self.counts[s] for s in slices] + [np.zeros(0, dtype=np.int32)]).astype(np.int64)
+        barcodes, inverse = np.unique(barcodes, return_inverse=True)
+        return barcodes, np.bincount(inverse.ravel(), weights=counts, minlength=barcodes.size).astype(np.int64)
+
+    #same as read_window_barcodes, for the given samples (all of them by default)
+    def window_barcodes(self, samples=None, windowNumbers=None):
+        windowNumbers = range(self.nWindows) if windowNumbers is None else windowNumbers
+        windowBarcodes = []
+        windowCounts = []
+        for windowNumber in windowNumbers:
+            barcodes, counts = self.window(windowNumber, samples)
+            windowBarcodes.append(barcodes)
+            windowCounts.append(counts)
+        return self.barcode_names(), windowBarcodes, windowCounts
+
+    #same as read_group_window_barcodes
+    def group_window_barcodes(self, groups):
+        groupBarcodes = []
+        groupCounts = []
+        for group in groups:
+            barcodeNames, windowBarcodes, windowCounts = self.window_barcodes(group)
+            groupBarcodes.append(windowBarcodes)
+            groupCounts.append(windowCounts)
+        return self.barcode_names(), groupBarcodes, groupCounts
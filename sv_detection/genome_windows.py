@@ -0,0 +1,116 @@
+#!/usr/bin/env python
+# Description: Functions to make genomic windows in-process from the chromosome lengths of a reference genome, for whole
+#              chromosomes or regions of them, with fixed or sliding windows
+# Usage: from genome_windows import chromosome_sizes, parse_region, make_windows, region_windows, windows_frame, write_windows
+#        windows = windows_frame(region_windows(genome, ["chr1:1-1000000", "chr2"], 50000))
+# Input: genome = reference genome (fasta, gzipped or not), its fasta index (.fai) or a file with chromosome names and lengths.
+#        Lengths are read from the fasta index if there is one (genome.fai), and otherwise from the fasta file itself
+# Output: windows = data frame with chromosome, start (0-based) and end of each window, as read from a window bed file
+# Modules required: os, re, gzip, pandas
+#########################################################################################################################
+
+import os, re, gzip
+import pandas as pd
+
+
+#########################################################################################################################
+
+'''Read chromosome names and lengths from the first two columns of a fasta index (or any tab separated file like it)'''
+def read_sizes_file(sizesFile, chromosomes=None):
+    sizes = {}
+    with open(sizesFile, "rt") as sf:
+        for line in sf:
+            fields = line.rstrip("\n").split("\t")
+            if len(fields) < 2 or (chromosomes is not None and fields[0] not in chromosomes): continue
+            sizes[fields[0]] = int(fields[1])
+    return sizes
+
+
+'''Read chromosome lengths from a fasta file by counting the bases of each sequence. If chromosomes are given, reading stops
+once all of them have been read, so chromosomes near the start of a large genome are found quickly.'''
+def read_fasta_sizes(fastaFile, chromosomes=None):
+    sizes = {}
+    name = None
+    wanted = set(chromosomes) if chromosomes is not None else None
+    with (gzip.open(fastaFile, "rt") if fastaFile.endswith(".gz") else open(fastaFile, "rt")) as fasta:
+        for line in fasta:
+            if line.startswith(">"):
+                if wanted is not None and wanted <= set(sizes): break
+                #the name of a sequence is the first word of its header, as in samtools faidx
+                name = line[1:].split()[0]
+                if wanted is None or name in wanted: sizes[name] = 0
+                else: name = None
+            elif name is not None:
+                sizes[name] += len(line.strip())
+    return sizes
+
+
+'''Lengths of the chromosomes of a genome (all of them, or only those given), in the order they are in the genome'''
+def chromosome_sizes(genome, chromosomes=None):
+    if os.path.exists(genome + ".fai"): sizes = read_sizes_file(genome + ".fai", chromosomes)
+    else:
+        with (gzip.open(genome, "rt") if genome.endswith(".gz") else open(genome, "rt")) as gf:
+            isFasta = gf.read(1) == ">"
+        sizes = read_fasta_sizes(genome, chromosomes) if isFasta else read_sizes_file(genome, chromosomes)
+    missing = [chromosome for chromosome in (chromosomes if chromosomes else []) if chromosome not in sizes]
+    if len(missing) > 0:
+        raise ValueError("Chromosomes not found in {}: {}".format(genome, ", ".join(missing)))
+    return sizes
+
+
+'''Chromosome, start and end of a region given as chr:start-end (1-based, inclusive), or a whole chromosome given as chr
+(start and end are then None)'''
+def parse_region(region):
+    match = re.match(r"^(.+):(\d+)-(\d+)$", region.replace(",", ""))
+    if not match: return region, None, None
+    start, end = int(match.group(2)), int(match.group(3))
+    if start < 1 or end < start:
+        raise ValueError("Region {} has a start after its end".format(region))
+    return match.group(1), start, end
+
+
+'''Windows of winSize bases starting every step bases (winSize by default, so windows don't overlap) along each region, as
+(chromosome, start, end) in bed coordinates. Regions are (chromosome, start, end) as given by parse_region, and are all
+chromosomes in sizes by default. Windows start at the start of each region, and the last window ends at its end, so it may
+be shorter than winSize (as with bedtools makewindows) rather than being left out.'''
+def make_windows(sizes, winSize, step=None, regions=None):
+    step = step if step else winSize
+    if winSize < 1 or step < 1:
+        raise ValueError("Window size and step must be positive")
+    regions = regions if regions is not None else [(chromosome, None, None) for chromosome in sizes]
+    windows = []
+    for chromosome, start, end in regions:
+        if chromosome not in sizes:
+            raise ValueError("Chromosome {} has no length".format(chromosome))
+        regionStart = start - 1 if start else 0
+        regionEnd = min(end, sizes[chromosome]) if end else sizes[chromosome]
+        if regionStart >= regionEnd:
+            raise ValueError("Region {}:{}-{} starts after the end of {} ({} bp)".format(chromosome, start, end, chromosome, sizes[chromosome]))
+        for windowStart in range(regionStart, regionEnd, step):
+            windowEnd = min(windowStart + winSize, regionEnd)
+            windows.append((chromosome, windowStart, windowEnd))
+            #windows after one that reaches the end of the region would only be part of it
+            if windowEnd == regionEnd: break
+    return windows
+
+
+'''Windows of chromosomes or regions of a genome (given as for parse_region, all chromosomes by default)'''
+def region_windows(genome, regions, winSize, step=None):
+    regions = [parse_region(region) for region in regions] if regions else None
+    sizes = chromosome_sizes(genome, list(dict.fromkeys([region[0] for region in regions])) if regions else None)
+    return make_windows(sizes, winSize, step, regions)
+
+
+'''Windows as a data frame, in the same form as a window bed file read with pandas (columns 0, 1 and 2)'''
+def windows_frame(windows):
+    windowFrame = pd.DataFrame(windows, columns=[0, 1, 2])
+    windowFrame[0] = windowFrame[0].astype(str)
+    windowFrame[1] = windowFrame[1].astype("int64")
+    windowFrame[2] = windowFrame[2].astype("int64")
+    return windowFrame
+
+
+'''Write windows to a bed file'''
+def write_windows(outFile, windows):
+    for chromosome, start, end in windows:
+        outFile.write("{}\t{}\t{}\n".format(chromosome, start, end))
@@ -0,0 +1,68 @@
+#!/usr/bin/env python
+# Description: This script takes a bam file and outputs the leftmost mapping position and barcode (BX tag) of each read in a region
+# Usage: python get_barcodes.py -b bam_file -c chromosome -s start -e end -q min_mapping_quality -o output_file
+# Input: bam_file = indexed bam file with barcodes stored in the BX tag
+#        chromosome, start and end = region to get barcodes from (1-based, inclusive)
+# Output: output_file = bed file with chromosome, position, position, barcode (as BX:Z:barcode) and sample name of each read
+# Modules required: argparse, sys, pysam, window_barcodes, stage_metrics
+#########################################################################################################################
+
+import argparse, sys, pysam
+
+from window_barcodes import sample_name, bam_barcode_reads
+from stage_metrics import StageMetrics
+
+#########################################################################################################################
+
+### parse arguments
+
+parser = argparse.ArgumentParser()
+
+#input and output files
+parser.add_argument("-b", "--bamFile", help="Input bam file", action = "store", required = True)
+parser.add_argument("-o", "--outFile", help="Output barcode bed file", action = "store")
+
+#region
+parser.add_argument("-c", "--chromosome", help="Chromosome name", action = "store", required = True)
+parser.add_argument("-s", "--start", help="Start position of the region", type=int, action = "store")
+parser.add_argument("-e", "--end", help="End position of the region", type=int, action = "store")
+
+#other
+parser.add_argument("-q", "--minMapQ", help="Minimum mapping quality", type=int, action = "store", default = 20)
+parser.add_argument("-n", "--sample", help="Sample name (default: name of the bam file without .bam)", action = "store")
+parser.add_argument("-t", "--threads", help="Decompression threads", type=int, action = "store", default = 1)
+parser.add_argument("--metrics", help="Append performance metrics of the run to this json lines file", action = "store")
+
+args = parser.parse_args()
+
+
+#########################################################################################################################
+
+#open files
+
+bamFile = pysam.AlignmentFile(args.bamFile, "rb", threads=args.threads)
+
+if args.outFile:
+    outFile = open(args.outFile, "wt")
+else: outFile = sys.stdout
+
+start = args.start - 1 if args.start else None
+
+sample = args.sample if args.sample else sample_name(args.bamFile)
+
+metrics = StageMetrics(args.metrics, "getbarcodes", chromosome=args.chromosome, sample=sample, threads=args.threads)
+
+
+#########################################################################################################################
+
+#barcodes are read straight from the BX tag, in the same way as wrath does, reads without one are skipped
+nReads = 0
+for position, barcode in bam_barcode_reads(bamFile, args.chromosome, start, args.end, args.minMapQ):
+    outFile.write("\t".join([args.chromosome, str(position), str(position), barcode, sample]) + "\n")
+    nReads += 1
+
+bamFile.close()
+outFile.close()
+
+metrics.count("reads", nReads)
+metrics.write()
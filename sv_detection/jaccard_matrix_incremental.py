@@ -0,0 +1,218 @@
+#!/usr/bin/env python
+# Description: This script takes a list of bam files and a list of windows (bed) and outputs a jaccard matrix of barcode sharing between windows for all samples together, updating the matrix of a previous run when samples are added
+# Usage: python jaccard_matrix_incremental.py -w window_file -g group_file -i index_dir -c cache_file -o output_file
+# Input: window_file = file with genomic window positions
+#        group_file = file with the paths of the bam files to use, one per line
+#        index_dir = directory where the barcodes of each window of each sample are kept (one file per sample)
+#        cache_file = file with the barcodes and intersection counts of all windows for the samples of the previous run (made if it doesn't exist).
+#                     Intersections are kept for the upper triangle of the matrix only, so the cache holds about half a matrix of 32 bit integers
+# Output: output_file = jaccard matrix, in the same format as jaccard_matrix_simplequeue.py
+# Modules required: argparse, sys, os, multiprocessing, pysam, numpy, pandas, stage_metrics
+#########################################################################################################################
+
+import argparse, sys, os
+from multiprocessing import Pool
+import numpy as np
+import pandas as pd
+
+from window_barcodes import sample_name, sample_names, read_bam_window_barcodes, save_sample_index, load_sample_index, window_positions
+from window_barcodes import filter_window_barcodes, intersection_counts
+from stage_metrics import StageMetrics
+
+import time
+start_time = time.time()
+
+
+#########################################################################################################################
+
+### parse arguments
+
+parser = argparse.ArgumentParser()
+
+#input and output files
+parser.add_argument("-w", "--winFile", help="Input window file", action = "store", required = True)
+parser.add_argument("-g", "--groupFile", help="File with the bam files of the samples, one per line", action = "store", required = True)
+parser.add_argument("-i", "--indexDir", help="Directory for the barcodes of each sample", action = "store", required = True)
+parser.add_argument("-c", "--cacheFile", help="File with the barcodes and intersection counts of the previous run", action = "store", required = True)
+parser.add_argument("-o", "--outFile", help="Output jaccard matrix file", action = "store")
+
+#barcode filtering (barcodes found in too many windows can't be excluded, as that changes when samples are added)
+parser.add_argument("--exclude_invalid", help="Exclude barcodes with a missing code (e.g. A00 or C00)", action = "store_true")
+parser.add_argument("--min_reads", help="Only count a barcode in a window if it has at least this number of reads in it", type=int, action = "store", default = 1)
+
+#other
+parser.add_argument("-q", "--minMapQ", help="Minimum mapping quality", type=int, action = "store", default = 20)
+parser.add_argument("-t", "--threads", help="Number of samples read at the same time", type=int, action = "store", default = 1)
+parser.add_argument("--metrics", help="Append performance metrics of the run to this json lines file", action = "store")
+
+args = parser.parse_args()
+
+metrics = StageMetrics(args.metrics, "matrix", threads=args.threads)
+
+
+#########################################################################################################################
+
+#open files
+
+if args.outFile:
+    outFile = open(args.outFile, "wt")
+else: outFile = sys.stdout
+
+#read windows
+windowFile = pd.read_csv(args.winFile, sep='\t', lineterminator='\n', header=None)
+num_win = windowFile.shape[0]
+chromosomes, starts, ends = window_positions(windowFile)
+
+#read samples
+with open(args.groupFile, "rt") as groupFile:
+    bamFiles = [line.strip() for line in groupFile if line.strip() != ""]
+try: samples = sample_names(bamFiles)
+except ValueError as error: sys.exit(str(error))
+
+
+#########################################################################################################################
+
+#functions
+
+'''Barcodes of all windows for one sample, from its index if there is one for these windows, or from its bam file otherwise
+(and then saved to the index)'''
+def sample_barcodes(bamFile):
+    indexFile = os.path.join(args.indexDir, sample_name(bamFile) + ".barcodes.npz")
+    if os.path.exists(indexFile):
+        sampleBarcodes = load_sample_index(indexFile, windowFile, args.minMapQ)
+        if sampleBarcodes is not None: return sampleBarcodes
+    sampleBarcodes = read_bam_window_barcodes(bamFile, windowFile, args.minMapQ)
+    save_sample_index(indexFile, *sampleBarcodes, windowFile, args.minMapQ)
+    return sampleBarcodes
+
+'''Load the cache of a previous run. Returns None if it was made with other windows or settings, or with samples that are
+not used now, as then the matrix has to be made from scratch.'''
+def load_cache(cacheFile):
+    if not os.path.exists(cacheFile): return None
+    with np.load(cacheFile) as cache:
+        if not (np.array_equal(cache["chromosomes"], chromosomes) and np.array_equal(cache["starts"], starts)
+                and np.array_equal(cache["ends"], ends)):
+            return None
+        #caches of older versions, without the mapping quality or with full intersection matrices, are made again
+        if "min_map_q" not in cache.files or cache["intersections"].ndim != 1: return None
+        if (bool(cache["exclude_invalid"]) != args.exclude_invalid or int(cache["min_reads"]) != args.min_reads
+                or int(cache["min_map_q"]) != args.minMapQ):
+            return None
+        cachedSamples = list(cache["samples"])
+        if not set(cachedSamples) <= set(samples): return None
+        offsets = cache["offsets"]
+        barcodes = cache["barcodes"]
+        counts = cache["counts"]
+        windowBarcodes = [barcodes[offsets[i]:offsets[i+1]] for i in range(num_win)]
+        windowCounts = [counts[offsets[i]:offsets[i+1]] for i in range(num_win)]
+        return cachedSamples, list(cache["barcodeNames"]), windowBarcodes, windowCounts, cache["intersections"]
+
+'''Save the barcodes (with their read counts, before filtering) and intersection counts of all windows'''
+def save_cache(cacheFile, barcodeNames, windowBarcodes, windowCounts, intersections):
+    offsets = np.zeros(num_win + 1, dtype=np.int64)
+    offsets[1:] = np.cumsum([barcodes.size for barcodes in windowBarcodes])
+    with open(cacheFile, "wb") as out:
+        np.savez_compressed(out, samples=np.array(samples, dtype=str), barcodeNames=np.array(barcodeNames, dtype=str), offsets=offsets,
+                 barcodes=np.concatenate(windowBarcodes + [np.zeros(0, dtype=np.int64)]),
+                 counts=np.concatenate(windowCounts + [np.zeros(0, dtype=np.int64)]),
+                 chromosomes=chromosomes, starts=starts, ends=ends, intersections=intersections,
+                 exclude_invalid=args.exclude_invalid, min_reads=args.min_reads, min_map_q=args.minMapQ)
+
+'''Add the barcodes of a sample to the barcodes of all windows. Barcodes are matched by name, so a barcode found in
+several samples counts once, as in the other matrix scripts.'''
+def add_sample_barcodes(barcodeIds, windowBarcodes, windowCounts, sampleBarcodes):
+    sampleNames, sampleWindowBarcodes, sampleWindowCounts = sampleBarcodes
+    ids = np.array([barcodeIds.setdefault(name, len(barcodeIds)) for name in sampleNames], dtype=np.int64)
+    for windowNumber in range(num_win):
+        barcodes = np.concatenate([windowBarcodes[windowNumber], ids[sampleWindowBarcodes[windowNumber]]])
+        counts = np.concatenate([windowCounts[windowNumber], sampleWindowCounts[windowNumber]])
+        windowBarcodes[windowNumber], inverse = np.unique(barcodes, return_inverse=True)
+        windowCounts[windowNumber] = np.bincount(inverse.ravel(), weights=counts, minlength=windowBarcodes[windowNumber].size).astype(np.int64)
+
+
+'''Start of the intersections of each row in the upper triangle of the matrix (row i has windows i to num_win - 1), kept as a
+single array'''
+def triangle_offsets(num_win):
+    rows = np.arange(num_win + 1, dtype=np.int64)
+    return rows * num_win - rows * (rows - 1) // 2
+
+
+#########################################################################################################################
+
+cache = load_cache(args.cacheFile)
+if cache is None:
+    sys.stderr.write("\nNo previous matrix for these samples and windows, making it from scratch\n")
+    cachedSamples, barcodeNames = [], []
+    oldBarcodes = [np.zeros(0, dtype=np.int64)] * num_win
+    oldCounts = [np.zeros(0, dtype=np.int64)] * num_win
+    intersections = np.zeros(num_win * (num_win + 1) // 2, dtype=np.int32)
+else:
+    cachedSamples, barcodeNames, oldBarcodes, oldCounts, intersections = cache
+
+newBamFiles = [bamFile for bamFile, sample in zip(bamFiles, samples) if sample not in cachedSamples]
+sys.stderr.write("Adding {} of {} samples to the matrix\n".format(len(newBamFiles), len(samples)))
+
+#read the barcodes of the new samples
+with Pool(processes=max(1, args.threads)) as pool:
+    newSampleBarcodes = pool.map(sample_barcodes, newBamFiles)
+
+barcodeIds = dict((name, i) for i, name in enumerate(barcodeNames))
+windowBarcodes = list(oldBarcodes)
+windowCounts = list(oldCounts)
+for sampleBarcodes in newSampleBarcodes:
+    add_sample_barcodes(barcodeIds, windowBarcodes, windowCounts, sampleBarcodes)
+barcodeNames = list(barcodeIds.keys())
+
+#barcodes used for the old and new matrices (barcodes can only be added to a window, as reads are only added)
+oldUsed, oldUsedCounts = filter_window_barcodes(barcodeNames, oldBarcodes, oldCounts, args.exclude_invalid, None, args.min_reads)
+newUsed, newUsedCounts = filter_window_barcodes(barcodeNames, windowBarcodes, windowCounts, args.exclude_invalid, None, args.min_reads)
+added = [np.setdiff1d(new, old, assume_unique=True) for new, old in zip(newUsed, oldUsed)]
+
+#only pairs of windows where at least one has added barcodes change, and intersections are updated in place in the upper
+#triangle. For a window i without added barcodes, the new intersection with a window j is the old one plus the barcodes
+#added to j that are in i. Rows of windows with added barcodes are counted again from all their barcodes, which takes as
+#long as counting their change
+changedWindows = np.flatnonzero([barcodes.size > 0 for barcodes in added])
+rowOffsets = triangle_offsets(num_win)
+comparisons = 0
+if changedWindows.size > 0:
+    sys.stderr.write("Updating intersections of {} windows\n".format(changedWindows.size))
+    inWindow = np.zeros(len(barcodeNames), dtype=bool)
+    changed = np.zeros(num_win, dtype=bool)
+    changed[changedWindows] = True
+    #windows with all their barcodes followed by windows with only their added barcodes
+    newAndAdded = newUsed + added
+    for windowNumber in range(num_win):
+        row = intersections[rowOffsets[windowNumber]:rowOffsets[windowNumber + 1]]
+        if changed[windowNumber]:
+            row[:] = intersection_counts(newUsed, windowNumber, range(windowNumber, num_win), inWindow)
+            comparisons += num_win - windowNumber
+        else:
+            columns = changedWindows[changedWindows > windowNumber]
+            if columns.size == 0: continue
+            row[columns - windowNumber] += intersection_counts(newAndAdded, windowNumber, columns + num_win, inWindow).astype(row.dtype)
+            comparisons += columns.size
+
+save_cache(args.cacheFile, barcodeNames, windowBarcodes, windowCounts, intersections)
+
+#write the matrix as in jaccard_matrix_simplequeue.py: windows before each row are 0 and pairs of empty windows give nan
+sizes = np.array([barcodes.size for barcodes in newUsed], dtype=np.float64)
+for windowNumber in range(num_win):
+    outArray = np.zeros(num_win)
+    array_i = intersections[rowOffsets[windowNumber]:rowOffsets[windowNumber + 1]].astype(np.float64)
+    array_u = sizes[windowNumber] + sizes[windowNumber:] - array_i
+    with np.errstate(invalid='ignore'):
+        outArray[windowNumber:] = np.divide(array_i, array_u)
+    np.savetxt(outFile, outArray, fmt='%.10f', newline=',')
+    outFile.write("\n")
+
+metrics.count("rows_written", num_win)
+metrics.count("comparisons", comparisons)
+metrics.write(chromosome=",".join(windowFile[0].astype(str).unique()), windows=num_win, barcodes=len(barcodeNames),
+              samples=len(samples), added_samples=len(newBamFiles), changed_windows=int(changedWindows.size))
+
+sys.stderr.write("\nDone\n")
+
+sys.stderr.write("My program took {} to run\n".format(time.time() - start_time))
+
+outFile.close()
@@ -0,0 +1,219 @@
+#!/usr/bin/env python
+# Description: This script takes a barcode file (bed) and a list of windows (bed) and outputs an approximate jaccard matrix of barcode sharing between windows, estimated from MinHash sketches
+# Usage: python jaccard_matrix_minhash.py -w window_file -b barcode_file -o output_file -e error [-r outliers_file] [-t threads]
+#        python jaccard_matrix_minhash.py --genome genome --regions chr:start-end --winSize window_size -b barcode_file -o output_file -e error
+# Input: window_file = file with genomic window positions (or windows are made from a genome, its fasta index or a file with chromosome lengths)
+#        barcode_file = file with barcodes and positions, or a barcode index made from it with make_barcode_index.py (-i)
+#        outliers_file = (optional) outliers detected from a previous approximate matrix, whose windows are recomputed exactly
+# Output: output_file = jaccard matrix, in the same format as jaccard_matrix_simplequeue.py
+# Modules required: argparse, sys, math, collections, multiprocessing, pysam, numpy, pandas, stage_metrics, genome_windows
+#########################################################################################################################
+
+import argparse, sys, math, pysam
+from collections import deque
+from multiprocessing import Pool
+import numpy as np
+import pandas as pd
+
+from window_barcodes import read_window_barcodes, filter_window_barcodes, jaccard_values
+from barcode_index import BarcodeIndex
+from genome_windows import region_windows, windows_frame, write_windows
+from stage_metrics import StageMetrics
+
+import time
+start_time = time.time()
+
+
+#########################################################################################################################
+
+### parse arguments
+
+parser = argparse.ArgumentParser()
+
+#input and output files
+parser.add_argument("-w", "--winFile", help="Input window file", action = "store")
+parser.add_argument("-b", "--barcodeFile", help="Input barcode file", action = "store")
+parser.add_argument("-i", "--index", help="Barcode index directory (from make_barcode_index.py), used instead of the barcode file", action = "store")
+parser.add_argument("-o", "--outFile", help="Output jaccard matrix file", action = "store")
+
+#windows made from the genome, instead of read from a window file
+parser.add_argument("--genome", help="Reference genome (fasta) or fasta index to make windows from, instead of a window file", action = "store")
+parser.add_argument("--regions", help="Chromosomes or regions (chr:start-end) to make windows of (default: all chromosomes)", nargs = "+", action = "store")
+parser.add_argument("--winSize", help="Window size", type=int, action = "store", default = 50000)
+parser.add_argument("--step", help="Distance between the starts of consecutive windows, for sliding windows (default: window size)", type=int, action = "store")
+parser.add_argument("--windowsOut", help="Also write the windows made from the genome to this bed file (e.g. for plotting)", action = "store")
+
+#sketches
+parser.add_argument("-e", "--error", help="Standard error of the estimated jaccard indices (sets the sketch size)", type=float, action = "store", default = 0.02)
+parser.add_argument("-k", "--sketchSize", help="Number of hash functions in each sketch (overrides --error)", type=int, action = "store")
+parser.add_argument("--seed", help="Seed for the hash functions", type=int, action = "store", default = 1)
+parser.add_argument("-r", "--refine", help="Outliers file (from outlier_detection.R). Comparisons involving these windows are computed exactly", action = "store")
+
+#barcode filtering
+parser.add_argument("--exclude_invalid", help="Exclude barcodes with a missing code (e.g. A00 or C00)", action = "store_true")
+parser.add_argument("--max_windows", help="Exclude barcodes found in more than this number of windows", type=int, action = "store")
+parser.add_argument("--min_reads", help="Only count a barcode in a window if it has at least this number of reads in it", type=int, action = "store", default = 1)
+
+#parallelisation
+parser.add_argument("-t", "--threads", help="Number of processes comparing sketches (blocks of rows are shared between them)", type=int, action = "store", default = 1)
+parser.add_argument("--blockSize", help="Number of rows of the matrix in each block given to a process", type=int, action = "store", default = 100)
+parser.add_argument("--maxBlocks", help="Maximum number of blocks of rows being computed or waiting to be written at once (default: twice the number of threads)", type=int, action = "store")
+
+#other
+parser.add_argument("--metrics", help="Append performance metrics of the run to this json lines file", action = "store")
+
+args = parser.parse_args()
+
+metrics = StageMetrics(args.metrics, "matrix_refine" if args.refine else "matrix", threads=args.threads)
+
+
+#########################################################################################################################
+
+#open files
+
+if args.outFile:
+    outFile = open(args.outFile, "wt")
+else: outFile = sys.stdout
+
+#read windows, or make them from the genome
+if args.winFile:
+    windowFile = pd.read_csv(args.winFile, sep='\t', lineterminator='\n', header=None)
+elif args.genome:
+    try: windows = region_windows(args.genome, args.regions, args.winSize, args.step)
+    except ValueError as error: sys.exit(str(error))
+    if args.windowsOut:
+        with open(args.windowsOut, "wt") as windowsOut: write_windows(windowsOut, windows)
+    windowFile = windows_frame(windows)
+else: sys.exit("Give a window file (-w) or a genome to make windows from (--genome)")
+num_win = windowFile.shape[0]
+
+#read barcodes, from the barcode index if there is one
+if args.index:
+    index = BarcodeIndex(args.index)
+    if not index.matches(windowFile):
+        sys.exit("Barcode index {} was made for other windows".format(args.index))
+else:
+    tbx = pysam.TabixFile(args.barcodeFile)
+
+
+#########################################################################################################################
+
+#functions
+
+#large prime for the hash functions. Barcode ids and hash values are below it, so everything fits in 64 bit integers
+prime = 2**31 - 1
+
+'''Scramble barcode ids (splitmix64 finaliser) so that consecutive ids don't give correlated hash values'''
+def mix_ids(barcodes):
+    x = barcodes.astype(np.uint64)
+    with np.errstate(over='ignore'):
+        x = (x ^ (x >> np.uint64(30))) * np.uint64(0xbf58476d1ce4e5b9)
+        x = (x ^ (x >> np.uint64(27))) * np.uint64(0x94d049bb133111eb)
+        x = x ^ (x >> np.uint64(31))
+    return (x % np.uint64(prime)).astype(np.int64)
+
+'''MinHash signature of each window: for each of the k hash functions h(x) = (a*x + b) mod prime, applied to the
+scrambled barcode ids, the smallest hash value of the barcodes in the window. Empty windows get prime, which no barcode can have.'''
+def minhash_signatures(windowBarcodes, k, seed):
+    rng = np.random.default_rng(seed)
+    a = rng.integers(1, prime, size=k, dtype=np.int64)
+    b = rng.integers(0, prime, size=k, dtype=np.int64)
+    signatures = np.full((len(windowBarcodes), k), prime, dtype=np.int64)
+    for windowNumber, barcodes in enumerate(windowBarcodes):
+        if barcodes.size == 0: continue
+        barcodes = mix_ids(barcodes)
+        #hash in chunks of barcodes to keep memory down for windows with many barcodes
+        for chunk in range(0, barcodes.size, 1024):
+            hashes = (np.outer(barcodes[chunk:chunk+1024], a) + b) % prime
+            signatures[windowNumber] = np.minimum(signatures[windowNumber], hashes.min(axis=0))
+    return signatures.astype(np.int32)
+
+'''Estimated jaccard index between window windowNumber and all windows after it: the fraction of hash functions
+with the same minimum in both windows. As in the exact matrix, windows before it are left as 0 and pairs of
+empty windows give nan.'''
+def minhash_row(signatures, empty, windowNumber):
+    outArray = np.zeros(signatures.shape[0])
+    outArray[windowNumber:] = (signatures[windowNumber:] == signatures[windowNumber]).mean(axis=1)
+    if empty[windowNumber]:
+        outArray[windowNumber:] = np.where(empty[windowNumber:], np.nan, 0)
+    else:
+        outArray[windowNumber:][empty[windowNumber:]] = 0
+    return outArray
+
+'''Keep the sketches and barcodes used to compute blocks of rows, so that they are sent once to each worker rather than with
+every block'''
+def init_worker(workerSignatures, workerEmpty, workerBarcodes, workerRefine, nBarcodes):
+    global signatures, empty, windowBarcodes, refineWindows, refineColumns, inWindow
+    signatures, empty, windowBarcodes, refineWindows = workerSignatures, workerEmpty, workerBarcodes, workerRefine
+    refineColumns = np.array(sorted(refineWindows), dtype=np.int64)
+    inWindow = np.zeros(nBarcodes, dtype=bool)
+
+'''Rows rowStart to rowEnd of the matrix: estimates from the sketches, replaced with exact values for the rows and columns of
+windows with outliers'''
+def minhash_block(rowStart, rowEnd):
+    num_win = signatures.shape[0]
+    outArray = np.zeros((rowEnd - rowStart, num_win))
+    for windowNumber in range(rowStart, rowEnd):
+        outRow = minhash_row(signatures, empty, windowNumber)
+        if windowNumber in refineWindows:
+            outRow[windowNumber:] = jaccard_values(windowBarcodes, windowNumber, range(windowNumber, num_win), inWindow)
+        else:
+            columns = refineColumns[refineColumns >= windowNumber]
+            if columns.size > 0: outRow[columns] = jaccard_values(windowBarcodes, windowNumber, columns, inWindow)
+        outArray[windowNumber - rowStart] = outRow
+    return outArray
+
+'''Write a block of rows'''
+def write_block(outArray):
+    for outRow in outArray:
+        np.savetxt(outFile, outRow, fmt='%.10f', newline=',')
+        outFile.write("\n")
+
+
+#########################################################################################################################
+
+#read the barcodes of every window once and drop uninformative ones
+sys.stderr.write("\nReading barcodes of {} windows\n".format(num_win))
+if args.index: barcodeNames, windowBarcodes, windowCounts = index.window_barcodes()
+else: barcodeNames, windowBarcodes, windowCounts = read_window_barcodes(tbx, windowFile)
+windowBarcodes, windowCounts = filter_window_barcodes(barcodeNames, windowBarcodes, windowCounts, args.exclude_invalid,
+                                                      args.max_windows, args.min_reads)
+
+#the standard error of the estimate is sqrt(J(1-J)/k), which is at most 1/(2*sqrt(k))
+sketchSize = args.sketchSize if args.sketchSize else int(math.ceil(1 / (4 * args.error**2)))
+sys.stderr.write("Making sketches of size {}\n".format(sketchSize))
+signatures = minhash_signatures(windowBarcodes, sketchSize, args.seed)
+empty = np.array([barcodes.size == 0 for barcodes in windowBarcodes], dtype=bool)
+
+#windows involved in outliers (outlier rows and columns are 1-based)
+refineWindows = set()
+if args.refine:
+    outliers = pd.read_csv(args.refine, sep=',', lineterminator='\n')
+    refineWindows = set(outliers["nrow"] - 1) | set(outliers["ncol"] - 1)
+    sys.stderr.write("Computing exact values for {} windows\n".format(len(refineWindows)))
+
+#blocks of rows are compared by the workers and written in order. Only maxBlocks blocks are queued or waiting to be written
+#at once, which bounds memory use. With a single thread the blocks are computed here
+blocks = [(rowStart, min(rowStart + args.blockSize, num_win)) for rowStart in range(0, num_win, args.blockSize)]
+if args.threads > 1:
+    maxBlocks = args.maxBlocks if args.maxBlocks else 2 * args.threads
+    with Pool(args.threads, initializer=init_worker, initargs=(signatures, empty, windowBarcodes, refineWindows, len(barcodeNames))) as pool:
+        pending = deque()
+        for rowStart, rowEnd in blocks:
+            if len(pending) >= maxBlocks: write_block(pending.popleft().get())
+            pending.append(pool.apply_async(minhash_block, (rowStart, rowEnd)))
+            metrics.gauge("blocks_pending", len(pending))
+        while pending: write_block(pending.popleft().get())
+else:
+    init_worker(signatures, empty, windowBarcodes, refineWindows, len(barcodeNames))
+    for rowStart, rowEnd in blocks: write_block(minhash_block(rowStart, rowEnd))
+
+metrics.count("rows_written", num_win)
+metrics.write(chromosome=",".join(windowFile[0].astype(str).unique()), windows=num_win, barcodes=len(barcodeNames),
+              sketch_size=sketchSize, refined_windows=len(refineWindows))
+
+sys.stderr.write("\nDone\n")
+
+sys.stderr.write("My program took {} to run\n".format(time.time() - start_time))
+
+outFile.close()
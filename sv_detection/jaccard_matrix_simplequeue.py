@@ -1,10 +1,14 @@
 #!/usr/bin/env python
 # Description: This script takes a barcode file (bed) and a list of windows (bed) and outputs a jaccard matrix of barcode sharing between windows
 # Usage: python jaccard_matrix.py -w window_file -b barcode_file -o output_file -t threads
-# Input: window_file = file with genomic window positions
-#        barcode_file = file with barcodes and positions
-# Output: output_file = jaccard matrix
-# Modules required: argparse, sys, gzip, random, pysam, math, numpy, pandas
+#        python jaccard_matrix.py -w window_file -b barcode_file -g group_file1 group_file2 -o output_file1 output_file2 -d difference_file -t threads
+#        python jaccard_matrix.py --genome genome --regions chr:start-end --winSize window_size [--step step] -b barcode_file -o output_file -t threads
+# Input: window_file = file with genomic window positions (or windows are made from a genome, its fasta index or a file with chromosome lengths)
+#        barcode_file = file with barcodes and positions (and sample names, if comparing groups), or a barcode index made from it with make_barcode_index.py (-i)
+#        group_files = (optional) lists of bam files of each group of samples
+# Output: output_file = jaccard matrix (one per group)
+#         difference_file = (optional) difference between the matrices of the first two groups
+# Modules required: argparse, sys, gzip, random, pysam, math, numpy, pandas, stage_metrics, profiling, genome_windows, tile_scheduler
 # Date: 27 September 2023
 # Author: Anna Orteu
 #########################################################################################################################
@@ -13,7 +17,14 @@ import argparse, sys, gzip, random, pysam, math
 import numpy as np
 import pandas as pd
 
-from threading import Thread
+from window_barcodes import sample_names, read_window_barcodes, read_group_window_barcodes, filter_window_barcodes
+from barcode_index import BarcodeIndex
+from genome_windows import region_windows, windows_frame, write_windows
+from stage_metrics import StageMetrics
+from profiling import Profiler, clear_profiles, merge_profiles
+from tile_scheduler import make_tiles, tile_values, TileStats, queue_tiles, sort_tiles, write_rows
+
+from threading import Thread, Semaphore
 
 from multiprocessing import Process
 
@@ -38,26 +49,77 @@ parser = argparse.ArgumentParser()
 #input and output files
 parser.add_argument("-w", "--winFile", help="Input window file", action = "store")
 parser.add_argument("-b", "--barcodeFile", help="Input barcode file", action = "store")
-parser.add_argument("-o", "--outFile", help="Output jaccard matrix file", action = "store")
+parser.add_argument("-i", "--index", help="Barcode index directory (from make_barcode_index.py), used instead of the barcode file", action = "store")
+parser.add_argument("-o", "--outFile", help="Output jaccard matrix file (one per group)", nargs = "+", action = "store")
+
+#windows made from the genome, instead of read from a window file
+parser.add_argument("--genome", help="Reference genome (fasta) or fasta index to make windows from, instead of a window file", action = "store")
+parser.add_argument("--regions", help="Chromosomes or regions (chr:start-end) to make windows of (default: all chromosomes)", nargs = "+", action = "store")
+parser.add_argument("--winSize", help="Window size", type=int, action = "store", default = 50000)
+parser.add_argument("--step", help="Distance between the starts of consecutive windows, for sliding windows (default: window size)", type=int, action = "store")
+parser.add_argument("--windowsOut", help="Also write the windows made from the genome to this bed file (e.g. for plotting)", action = "store")
+
+#groups
+parser.add_argument("-g", "--groups", help="Lists of bam files of each group of samples to make a matrix for", nargs = "+", action = "store")
+parser.add_argument("-d", "--diffFile", help="Output file for the difference between the matrices of the first two groups", action = "store")
+
+#barcode filtering
+parser.add_argument("--exclude_invalid", help="Exclude barcodes with a missing code (e.g. A00 or C00)", action = "store_true")
+parser.add_argument("--max_windows", help="Exclude barcodes found in more than this number of windows", type=int, action = "store")
+parser.add_argument("--min_reads", help="Only count a barcode in a window if it has at least this number of reads in it", type=int, action = "store", default = 1)
 
 #other
 parser.add_argument("-t", "--threads", help="Analysis threads", type=int, action = "store", default = 1)
+parser.add_argument("--tileSize", help="Number of windows in each side of the tiles the matrix is split into", type=int, action = "store", default = 100)
+parser.add_argument("--maxBlocks", help="Maximum number of blocks of rows held in memory waiting to be written (default: twice the number of threads)", type=int, action = "store")
 parser.add_argument("--test", help="Test - runs 10 windows", action='store_true')
 parser.add_argument("--verbose", help="Verbose output", action = "store_true")
+parser.add_argument("--metrics", help="Append performance metrics of the run to this json lines file", action = "store")
+parser.add_argument("--profile", help="Profile the run (each worker, the sorter and the writer separately) and write the profiles and a merged report to this directory", action = "store")
 
 args = parser.parse_args()
 
+metrics = StageMetrics(args.metrics, "matrix", threads=args.threads, tile_size=args.tileSize)
+
+#time spent fetching and parsing barcodes, computing, passing tiles and rows between processes and writing, per process
+if args.profile: clear_profiles(args.profile)
+profiler = Profiler(args.profile, "main").start()
+
 
 #########################################################################################################################
 
 #open files
 
-if args.outFile:
-    outFile = open(args.outFile, "wt")
-else: outFile = sys.stdout
+if args.groups:
+    if not args.outFile or len(args.outFile) != len(args.groups):
+        sys.exit("An output file is needed for each group")
+    if args.diffFile and len(args.groups) < 2:
+        sys.exit("At least two groups are needed for a difference matrix")
+    #samples are named after their bam files, as in get_barcodes.py
+    groupBams = []
+    for groupFile in args.groups:
+        with open(groupFile, "rt") as gf:
+            groupBams.append([line.strip() for line in gf if line.strip()])
+    try: sample_names([bam for bams in groupBams for bam in bams])
+    except ValueError as error: sys.exit(str(error))
+    groups = [set(sample_names(bams)) for bams in groupBams]
 
-#read windows
-windowFile = pd.read_csv(args.winFile, sep='\t', lineterminator='\n', header=None)
+if args.outFile:
+    outFiles = [open(outFile, "wt") for outFile in args.outFile]
+else: outFiles = [sys.stdout]
+
+diffFile = open(args.diffFile, "wt") if args.diffFile else None
+
+#read windows, or make them from the genome
+if args.winFile:
+    windowFile = pd.read_csv(args.winFile, sep='\t', lineterminator='\n', header=None)
+elif args.genome:
+    try: windows = region_windows(args.genome, args.regions, args.winSize, args.step)
+    except ValueError as error: sys.exit(str(error))
+    if args.windowsOut:
+        with open(args.windowsOut, "wt") as windowsOut: write_windows(windowsOut, windows)
+    windowFile = windows_frame(windows)
+else: sys.exit("Give a window file (-w) or a genome to make windows from (--genome)")
 num_win = windowFile.shape[0]
 
 #create a matrix of n x n, n = number of windows to compare
@@ -65,8 +127,13 @@ windowFile=pd.DataFrame(windowFile)
 windowFile.index.name = 'index'
 windowFile.reset_index(inplace=True)
 
-#read barcodes
-tbx = pysam.TabixFile(args.barcodeFile)
+#read barcodes, from the barcode index if there is one
+if args.index:
+    index = BarcodeIndex(args.index)
+    if not index.matches(windowFile):
+        sys.exit("Barcode index {} was made for other windows".format(args.index))
+else:
+    tbx = pysam.TabixFile(args.barcodeFile)
 
 
 #########################################################################################################################
@@ -74,102 +141,75 @@ tbx = pysam.TabixFile(args.barcodeFile)
 #functions
 
 '''A function that reads from the input queue, calls some other function and writes to the results queue
-This function needs to be tailored to the particular analysis funcion(s) you're using. This is the function that will run on each of the N cores.'''
-def freqs_wrapper(inQueue, resultQueue, number_win, inFile):
+This function needs to be tailored to the particular analysis funcion(s) you're using. This is the function that will run on each of the N cores.
+Each item in the queue is a tile of the upper triangle of the matrix (see tile_scheduler.py), which is computed for every group.'''
+def freqs_wrapper(inQueue, resultQueue, groupBarcodes, nBarcodes, profileDir=None):
+    profiler = Profiler(profileDir, "worker").start()
+    getTile = profiler.timed("transfer", inQueue.get)
+    putResult = profiler.timed("transfer", resultQueue.put)
+    inWindow = np.zeros(nBarcodes, dtype=bool)
+    busy = 0 #time spent computing, sent back when done to measure worker utilisation
     while True:
-        windowNumber,windowLine = inQueue.get() # retrieve window
-        if windowNumber == -1:
-            resultQueue.put((-1,None,)) # this is the way of telling everything we're done
+        blockNumber,tile = getTile() # retrieve tile
+        if blockNumber == -1:
+            putResult((-1,None,busy,)) # this is the way of telling everything we're done
+            profiler.stop()
             break
-        array_i = np.zeros((number_win))
-        array_u = np.ones((number_win))
-        bedfile1 = inFile.fetch(windowLine[0], windowLine[1], windowLine[2],  parser=pysam.asBed(), multiple_iterators=True)
-        barcodes1 = [rowbed1.name for rowbed1 in bedfile1]
-        for index2, row2 in windowFile.iloc[windowNumber:,:].iterrows():
-            bedfile2 = inFile.fetch(row2[0], row2[1], row2[2], parser=pysam.asBed(), multiple_iterators=True)
-            barcodes2 = [rowbed2.name for rowbed2 in bedfile2]
-            intersect = np.intersect1d(barcodes1, barcodes2)
-            union = np.union1d(barcodes1, barcodes2)
-            array_i[index2] = intersect.size
-            if union.size>1:
-                array_u[index2] = union.size
-            elif union.size<1:
-                array_u[index2] = 1
-                array_i[index2] = 0
-            array_u[index2] = union.size
-        outArray = np.divide(array_i, array_u)
-        resultQueue.put((windowNumber, outArray,))
-
-
-'''a function that watches the result queue and sorts results. This should be a generic funcion regardless of the result, as long as the first object is the line number, and this increases consecutively.'''
-def sorter(doneQueue, writeQueue, verbose, nWorkerThreads):
-    global resultsReceived
-    sortBuffer = {}
-    expect = 0
-    threadsComplete = 0 #this will keep track of the worker threads and once they're all done this thread will break
-    while True:
-        windowNumber, results = doneQueue.get()
-        #check if we're done
-        if windowNumber == -1: threadsComplete += 1
-        if threadsComplete == nWorkerThreads:
-            writeQueue.put((-1,None,))
-            break #this is the way of telling everything we're done
-        resultsReceived += 1
-        if verbose:
-            sys.stderr.write("Sorter received window {}\n".format(windowNumber))
-        if windowNumber == expect:
-            writeQueue.put((windowNumber,results))
-            if verbose:
-                sys.stderr.write("window {} sent to writer\n".format(windowNumber))
-            expect +=1
-            #now check buffer for further results
-            while True:
-                try:
-                    results = sortBuffer.pop(str(expect))
-                    writeQueue.put((expect,results))
-                    if verbose:
-                        sys.stderr.write("window {} sent to writer\n".format(expect))
-                    expect +=1
-                except:
-                    break
-        else:
-            #otherwise this line is ahead of us, so add to buffer dictionary
-            sortBuffer[str(windowNumber)] = results
-
-
-
-'''a writer function that writes the sorted result. This is also generic'''
-def writer(writeQueue, out, verbose):
-    global resultsWritten
-    while True:
-        windowNumber, results = writeQueue.get()
-        #check if we're done
-        if windowNumber == -1: break
-        if verbose:
-            sys.stderr.write("Writer received window {}\n".format(windowNumber))
-        np.savetxt(out, results, fmt='%.10f', newline=',')
-        out.write("\n")
-        resultsWritten += 1
+        tileStart = time.time()
+        with profiler.phase("compute"):
+            outArray = tile_values(tile, groupBarcodes, inWindow)
+        busy += time.time() - tileStart
+        putResult((blockNumber, tile[2], outArray,))
+
 
 '''loop that checks line stats'''
 def checkStats():
     while True:
         sleep(10)
-        sys.stderr.write("{} windows queued | {} windows analysed | {} windows written\n".format(windowQueued,resultsReceived,resultsWritten))
+        sys.stderr.write("{} tiles queued | {} tiles analysed | {} windows written\n".format(stats.tilesQueued,stats.tilesReceived,stats.rowsWritten))
 
 
 
 
 
+#########################################################################################################################
+
+readStart = time.time()
+
+#read the barcodes of every window once, as sorted arrays of unique integer ids, and drop uninformative ones
+#when comparing groups, all of them are read in the same pass and share the barcode ids
+sys.stderr.write("\nReading barcodes of {} windows\n".format(num_win))
+#(reading from a barcode index is timed as fetching, as barcodes are stored there as arrays)
+if args.groups:
+    if args.index:
+        with profiler.phase("fetch"):
+            try: barcodeNames, groupBarcodes, groupCounts = index.group_window_barcodes(groups)
+            except KeyError as error: sys.exit(error.args[0])
+    else: barcodeNames, groupBarcodes, groupCounts = read_group_window_barcodes(tbx, windowFile, groups, profiler)
+else:
+    if args.index:
+        with profiler.phase("fetch"): barcodeNames, windowBarcodes, windowCounts = index.window_barcodes()
+    else: barcodeNames, windowBarcodes, windowCounts = read_window_barcodes(tbx, windowFile, profiler)
+    groupBarcodes, groupCounts = [windowBarcodes], [windowCounts]
+with profiler.phase("compute"):
+    for groupNumber in range(len(groupBarcodes)):
+        groupBarcodes[groupNumber], groupCounts[groupNumber] = filter_window_barcodes(barcodeNames, groupBarcodes[groupNumber], groupCounts[groupNumber],
+                                                                                      args.exclude_invalid, args.max_windows, args.min_reads)
+readTime = time.time() - readStart
+
+
 #########################################################################################################################
 
 #counting stat that will let keep track of how far we are
-windowQueued = 0
-resultsReceived = 0
-resultsWritten = 0
-linesWritten = 0
+stats = TileStats()
+
+#split the matrix into tiles (only the first 10 rows if testing)
+blocks = make_tiles(min(10, num_win) if args.test else num_win, num_win, args.tileSize)
 
-'''Create queues to hold the data one will hold the line info to be passed to the analysis'''
+#blocks of rows are only queued when there is space for them in the sorter buffer, which bounds its memory use
+blockSlots = Semaphore(args.maxBlocks if args.maxBlocks else max(2, 2*args.threads))
+
+'''Create queues to hold the data one will hold the tiles to be passed to the analysis'''
 inQueue = SimpleQueue()
 #one will hold the results (in the order they come)
 resultQueue = SimpleQueue()
@@ -180,22 +220,24 @@ writeQueue = SimpleQueue()
 '''start worker Processes for analysis. The command should be tailored for the analysis wrapper function
 of course these will only start doing anything after we put data into the line queue
 the function we call is actually a wrapper for another function.(s) This one reads from the line queue, passes to some analysis function(s), gets the results and sends to the result queue'''
+computeStart = time.time()
 workerThreads = []
 sys.stderr.write("\nStarting {} worker threads\n".format(args.threads))
 for x in range(args.threads):
-  workerThread = Process(target=freqs_wrapper, args = (inQueue, resultQueue, num_win, tbx,))
+  workerThread = Process(target=freqs_wrapper, args = (inQueue, resultQueue, groupBarcodes, len(barcodeNames), args.profile,))
   workerThread.daemon = True
   workerThread.start()
   workerThreads.append(workerThread)
 
 
 '''thread for sorting results'''
-sorterThread = Thread(target=sorter, args=(resultQueue, writeQueue, args.verbose, args.threads,))
+sorterThread = Thread(target=sort_tiles, args=(resultQueue.get, lambda rowNumber, row: writeQueue.put((rowNumber, row,)), blocks, len(groupBarcodes), num_win,
+                                                 blockSlots, args.threads, stats, args.verbose, args.profile,))
 sorterThread.daemon = True
 sorterThread.start()
 
 '''start thread for writing the results'''
-writerThread = Thread(target=writer, args=(writeQueue, outFile, args.verbose,))
+writerThread = Thread(target=write_rows, args=(writeQueue.get, outFiles, diffFile, stats, args.verbose, args.profile, True,))
 writerThread.daemon = True
 writerThread.start()
 
@@ -205,18 +247,14 @@ checkerThread = Thread(target=checkStats)
 checkerThread.daemon = True
 checkerThread.start()
 
+#tiles waiting for or being computed by a worker, and rows waiting to be written
+metrics.sample(stats.pending)
+
 #########################################################################################################################
 
 
-if not args.test:
-    for windowIdx, windowLine in windowFile.iterrows():
-        inQueue.put((windowQueued,windowLine))
-        windowQueued += 1
-else:
-    for windowIdx, windowLine in windowFile.iterrows():
-        inQueue.put((windowQueued,windowLine))
-        windowQueued += 1
-        if windowQueued == 10: break
+#tiles are handed out to whichever worker is free, in order of blocks of rows
+queue_tiles(blocks, lambda blockNumber, tile: inQueue.put((blockNumber,tile,)), blockSlots, stats, profiler)
 
 
 #########################################################################################################################
@@ -232,10 +270,23 @@ for x in range(len(workerThreads)):
 sorterThread.join()
 writerThread.join()
 
+computeTime = time.time() - computeStart
+metrics.count("rows_written", stats.rowsWritten)
+metrics.count("tiles", stats.tilesReceived)
+#pairs of windows compared (each row is compared with itself and the windows after it)
+metrics.count("comparisons", sum(num_win - row for row in range(min(10, num_win) if args.test else num_win)) * len(groupBarcodes))
+metrics.write(chromosome=",".join(windowFile[0].astype(str).unique()), windows=num_win, groups=len(groupBarcodes), barcodes=len(barcodeNames),
+              read_s=round(readTime, 3), compute_s=round(computeTime, 3), worker_utilisation=stats.utilisation(args.threads, computeTime))
+
+if args.profile:
+    profiler.stop()
+    sys.stderr.write("\nProfile report written to {}\n".format(merge_profiles(args.profile)))
+
 sys.stderr.write("\nDone\n")
 
 sys.stderr.write("My program took {} to run\n".format(time.time() - start_time))
 
-outFile.close()
+for outFile in outFiles: outFile.close()
+if diffFile: diffFile.close()
 
 sys.exit()
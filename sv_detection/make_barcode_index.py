@@ -0,0 +1,56 @@
+#!/usr/bin/env python
+# Description: This script takes a barcode file (bed) and a list of windows (bed) and writes a binary index of the barcodes in each window of each sample, which can be used instead of the barcode file by the matrix scripts and query_barcode_index.py
+# Usage: python make_barcode_index.py -w window_file -b barcode_file -o index_dir
+# Input: window_file = file with genomic window positions
+#        barcode_file = file with barcodes and positions (and sample names)
+# Output: index_dir = barcode index directory (see barcode_index.py)
+# Modules required: argparse, sys, pysam, numpy, pandas, stage_metrics
+#########################################################################################################################
+
+import argparse, sys, pysam
+import pandas as pd
+
+from barcode_index import build_barcode_index, write_barcode_index
+from stage_metrics import StageMetrics
+
+import time
+start_time = time.time()
+
+
+#########################################################################################################################
+
+### parse arguments
+
+parser = argparse.ArgumentParser()
+
+#input and output files
+parser.add_argument("-w", "--winFile", help="Input window file", action = "store", required = True)
+parser.add_argument("-b", "--barcodeFile", help="Input barcode file", action = "store", required = True)
+parser.add_argument("-o", "--indexDir", help="Output barcode index directory", action = "store", required = True)
+
+#other
+parser.add_argument("--metrics", help="Append performance metrics of the run to this json lines file", action = "store")
+
+args = parser.parse_args()
+
+metrics = StageMetrics(args.metrics, "index")
+
+
+#########################################################################################################################
+
+#read windows
+windowFile = pd.read_csv(args.winFile, sep='\t', lineterminator='\n', header=None)
+
+#read barcodes
+tbx = pysam.TabixFile(args.barcodeFile)
+
+sys.stderr.write("\nIndexing barcodes of {} windows\n".format(windowFile.shape[0]))
+barcodeNames, sampleNames, windowKeys, windowCounts = build_barcode_index(tbx, windowFile)
+write_barcode_index(args.indexDir, barcodeNames, sampleNames, windowKeys, windowCounts, windowFile)
+sys.stderr.write("Indexed {} barcodes of {} samples\n".format(len(barcodeNames), len(sampleNames)))
+
+metrics.count("reads", int(sum(counts.sum() for counts in windowCounts)))
+metrics.count("windows", windowFile.shape[0])
+metrics.write(chromosome=",".join(windowFile[0].astype(str).unique()), barcodes=len(barcodeNames), samples=len(sampleNames))
+
+sys.stderr.write("My program took {} to run\n".format(time.time() - start_time))
@@ -0,0 +1,65 @@
+#!/usr/bin/env python
+# Description: This script takes a reference genome and outputs genomic windows (bed) of one or more chromosomes or regions, without indexing the genome
+# Usage: python make_windows.py -g genome -c chromosome [chromosome ...] -w window_size [-s step] -o window_file
+#        python make_windows.py -g genome -r chr:start-end [chr:start-end ...] -w window_size [-s step] -o window_file
+#        python make_windows.py -g genome -c chromosome --sizes (chromosome names and lengths)
+# Input: genome = reference genome (fasta), its fasta index (.fai) or a file with chromosome names and lengths
+#        regions = chromosomes or regions (chr:start-end, 1-based, inclusive) to make windows of
+# Output: window_file = bed file with genomic window positions
+# Modules required: argparse, sys, genome_windows
+#########################################################################################################################
+
+import argparse, sys
+
+from genome_windows import chromosome_sizes, region_windows, write_windows
+
+
+#########################################################################################################################
+
+### parse arguments
+
+parser = argparse.ArgumentParser()
+
+#input and output files
+parser.add_argument("-g", "--genome", help="Reference genome (fasta), fasta index or file with chromosome lengths", action = "store", required = True)
+parser.add_argument("-o", "--outFile", help="Output window file", action = "store")
+
+#regions
+parser.add_argument("-c", "--chromosomes", help="Chromosomes to make windows of (default: all)", nargs = "+", action = "store")
+parser.add_argument("-r", "--regions", help="Regions to make windows of (chr:start-end, or chr for a whole chromosome)", nargs = "+", action = "store")
+
+#windows
+parser.add_argument("-w", "--winSize", help="Window size", type=int, action = "store", default = 50000)
+parser.add_argument("-s", "--step", help="Distance between the starts of consecutive windows, for sliding windows (default: window size)", type=int, action = "store")
+
+#other
+parser.add_argument("--sizes", help="Output the name and length of each chromosome instead of windows", action = "store_true")
+
+args = parser.parse_args()
+
+#regions can be whole chromosomes, so chromosomes and regions are not given together
+if args.regions and args.chromosomes:
+    parser.error("give chromosomes (-c) or regions (-r), not both (whole chromosomes can be given as regions)")
+if args.regions and args.sizes:
+    parser.error("--sizes gives the lengths of chromosomes (-c), not of regions (-r)")
+
+
+#########################################################################################################################
+
+if args.outFile:
+    outFile = open(args.outFile, "wt")
+else: outFile = sys.stdout
+
+#whole chromosomes are regions too
+regions = args.regions if args.regions else args.chromosomes
+
+try:
+    if args.sizes:
+        for chromosome, size in chromosome_sizes(args.genome, args.chromosomes).items():
+            outFile.write("{}\t{}\n".format(chromosome, size))
+    else:
+        write_windows(outFile, region_windows(args.genome, regions, args.winSize, args.step))
+except ValueError as error:
+    sys.exit(str(error))
+
+outFile.close()
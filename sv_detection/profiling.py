@@ -0,0 +1,134 @@
+#!/usr/bin/env python
+# Description: Profiling of scripts that run several processes and threads. Each one keeps a cProfile profile and the time
+#              spent in each phase of its work (e.g. fetch, parse, compute, transfer and write), which are saved to a profile
+#              directory and merged into a single report
+# Usage: from profiling import Profiler, clear_profiles, merge_profiles
+#        clear_profiles(profile_dir)
+#        profiler = Profiler(profile_dir, name).start(); with profiler.phase("compute"): ...; profiler.stop()
+#        merge_profiles(profile_dir)
+#        python profiling.py profile_dir (merge the profiles of a run again, e.g. with more functions)
+# Output: profile_dir/NAME.PID.prof         cProfile statistics of a process or thread
+#         profile_dir/NAME.PID.phases.json  time spent in each phase, and in total
+#         profile_dir/report.txt            phase times of all processes, and their merged cProfile statistics
+# Modules required: sys, os, glob, json, time, cProfile, pstats, threading, contextlib
+#########################################################################################################################
+
+import sys, os, glob, json, time, cProfile, pstats, threading
+from contextlib import contextmanager
+
+
+#########################################################################################################################
+
+'''Profile of one process or thread. If profileDir is None nothing is measured, so scripts can always use one. The cProfile
+profile only covers the thread that started it, so each thread of interest gets its own Profiler. A stopped profiler can be
+started again, and carries on adding to the same profile, so that the workers of a pool can profile each task they run and
+save their profile after it.'''
+class Profiler:
+    def __init__(self, profileDir, name):
+        self.profileDir = profileDir
+        self.name = name
+        self.enabled = profileDir is not None
+        self.phaseTimes = {}
+        self.phaseCalls = {}
+        self.profile = None
+        self.startTime = None
+
+    def start(self):
+        if not self.enabled: return self
+        os.makedirs(self.profileDir, exist_ok=True)
+        if self.startTime is None:
+            self.startTime = time.perf_counter()
+            self.profile = cProfile.Profile()
+        #only one cProfile profile can be active at a time from Python 3.12, in which case only phases are timed
+        if self.profile is not None:
+            try: self.profile.enable()
+            except ValueError: self.profile = None
+        return self
+
+    #add time spent in a phase
+    def add(self, name, seconds, calls=1):
+        self.phaseTimes[name] = self.phaseTimes.get(name, 0) + seconds
+        self.phaseCalls[name] = self.phaseCalls.get(name, 0) + calls
+
+    #time a block of code as a phase (with profiler.phase("compute"): ...)
+    @contextmanager
+    def phase(self, name):
+        if not self.enabled:
+            yield
+            return
+        startTime = time.perf_counter()
+        try: yield
+        finally: self.add(name, time.perf_counter() - startTime)
+
+    #a function that does the same as function, timed as a phase. When not profiling it is the function itself, so it can be
+    #used in loops over single reads without slowing them down
+    def timed(self, name, function):
+        if not self.enabled: return function
+        def timedFunction(*args, **kwargs):
+            startTime = time.perf_counter()
+            try: return function(*args, **kwargs)
+            finally: self.add(name, time.perf_counter() - startTime)
+        return timedFunction
+
+    #save the profile and phase times (so far, if the profiler is started again)
+    def stop(self):
+        if not self.enabled: return
+        fileName = os.path.join(self.profileDir, "{}.{}".format(self.name, os.getpid()))
+        if threading.current_thread() is not threading.main_thread():
+            fileName += ".{}".format(threading.get_ident())
+        if self.profile is not None:
+            self.profile.disable()
+            self.profile.dump_stats(fileName + ".prof")
+        with open(fileName + ".phases.json", "wt") as phasesFile:
+            json.dump({"name": self.name, "pid": os.getpid(), "wall_s": time.perf_counter() - self.startTime,
+                       "phases": self.phaseTimes, "calls": self.phaseCalls}, phasesFile)
+
+
+'''Make a profile directory for a run, removing the profiles of previous runs from it so that they are not merged'''
+def clear_profiles(profileDir):
+    os.makedirs(profileDir, exist_ok=True)
+    for profileFile in glob.glob(os.path.join(profileDir, "*.prof")) + glob.glob(os.path.join(profileDir, "*.phases.json")):
+        os.remove(profileFile)
+
+
+'''Merge the profiles saved in a profile directory into one report: the time spent in each phase summed over all processes,
+the phases of each process (time not in any phase is given as other), and the cProfile statistics of all processes
+together, sorted by cumulative time'''
+def merge_profiles(profileDir, reportFile=None, nFunctions=40):
+    reportFile = reportFile if reportFile else os.path.join(profileDir, "report.txt")
+    processes = []
+    for phasesFile in sorted(glob.glob(os.path.join(profileDir, "*.phases.json"))):
+        with open(phasesFile, "rt") as phases:
+            processes.append(json.load(phases))
+    phaseNames = sorted(set(name for process in processes for name in process["phases"]))
+    with open(reportFile, "wt") as report:
+        report.write("Time (s) in each phase, summed over {} processes and threads\n".format(len(processes)))
+        report.write("\t".join(["phase", "total_s", "calls", "processes"]) + "\n")
+        for name in phaseNames:
+            withPhase = [process for process in processes if name in process["phases"]]
+            report.write("\t".join([name, "{:.3f}".format(sum(process["phases"][name] for process in withPhase)),
+                                    str(sum(process["calls"][name] for process in withPhase)), str(len(withPhase))]) + "\n")
+        report.write("\nTime (s) in each phase of each process and thread\n")
+        report.write("\t".join(["name", "pid", "wall_s"] + phaseNames + ["other"]) + "\n")
+        for process in processes:
+            phases = process["phases"]
+            report.write("\t".join([process["name"], str(process["pid"]), "{:.3f}".format(process["wall_s"])] +
+                                   ["{:.3f}".format(phases[name]) if name in phases else "" for name in phaseNames] +
+                                   ["{:.3f}".format(process["wall_s"] - sum(phases.values()))]) + "\n")
+        profileFiles = sorted(glob.glob(os.path.join(profileDir, "*.prof")))
+        if len(profileFiles) > 0:
+            report.write("\nFunctions of all processes and threads ({} profiles merged)\n".format(len(profileFiles)))
+            stats = pstats.Stats(*profileFiles, stream=report)
+            stats.strip_dirs().sort_stats("cumulative").print_stats(nFunctions)
+    return reportFile
+
+
+#########################################################################################################################
+
+if __name__ == "__main__":
+    if len(sys.argv) < 2:
+        sys.stderr.write("Usage: python profiling.py profile_dir [number_of_functions]\n")
+        sys.exit(1)
+    reportFile = merge_profiles(sys.argv[1], nFunctions=int(sys.argv[2]) if len(sys.argv) > 2 else 40)
+    with open(reportFile, "rt") as report:
+        sys.stdout.write(report.read())
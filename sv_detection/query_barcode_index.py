@@ -0,0 +1,89 @@
+#!/usr/bin/env python
+# Description: This script takes a barcode index (from make_barcode_index.py) and outputs the barcodes found in a region, or the barcodes shared by two regions and their jaccard index
+# Usage: python query_barcode_index.py -i index_dir -r chr:start-end [chr:start-end] [-g group_file] [-o output_file]
+# Input: index_dir = barcode index directory
+#        regions = one or two regions. Regions are made of the indexed windows that overlap them
+#        group_file = (optional) list of bam files of the samples to use (all samples by default)
+# Output: output_file = barcodes and number of reads of each in a region, or the barcodes shared by two regions (with their
+#         number of reads in each) followed by the jaccard index of the regions
+# Modules required: argparse, sys, re, numpy
+#########################################################################################################################
+
+import argparse, sys, re
+import numpy as np
+
+from barcode_index import BarcodeIndex
+from window_barcodes import sample_names
+
+
+#########################################################################################################################
+
+### parse arguments
+
+parser = argparse.ArgumentParser()
+
+parser.add_argument("-i", "--indexDir", help="Barcode index directory", action = "store", required = True)
+parser.add_argument("-r", "--regions", help="One or two regions (chr:start-end)", nargs = "+", action = "store", required = True)
+parser.add_argument("-g", "--groupFile", help="List of bam files of the samples to use (default: all)", action = "store")
+parser.add_argument("-o", "--outFile", help="Output file", action = "store")
+
+args = parser.parse_args()
+
+if len(args.regions) > 2:
+    sys.exit("Give one or two regions")
+
+
+#########################################################################################################################
+
+#open files
+
+if args.outFile:
+    outFile = open(args.outFile, "wt")
+else: outFile = sys.stdout
+
+index = BarcodeIndex(args.indexDir)
+
+samples = None
+if args.groupFile:
+    with open(args.groupFile, "rt") as gf:
+        try: samples = sample_names([line.strip() for line in gf if line.strip()])
+        except ValueError as error: sys.exit(str(error))
+
+
+#########################################################################################################################
+
+#functions
+
+'''Barcodes of the windows overlapping a region, with their number of reads'''
+def region_barcodes(region):
+    match = re.match(r"^(.+):(\d+)-(\d+)$", region.replace(",", ""))
+    if not match:
+        sys.exit("Region {} is not of the form chr:start-end".format(region))
+    windowNumbers = index.region_windows(match.group(1), int(match.group(2)), int(match.group(3)))
+    if windowNumbers.size == 0:
+        sys.exit("No indexed windows overlap region {}".format(region))
+    sys.stderr.write("Region {} covers windows {} to {}\n".format(region, windowNumbers[0] + 1, windowNumbers[-1] + 1))
+    try: barcodeNames, windowBarcodes, windowCounts = index.window_barcodes(samples, windowNumbers)
+    except KeyError as error: sys.exit(error.args[0])
+    barcodes, inverse = np.unique(np.concatenate(windowBarcodes), return_inverse=True)
+    counts = np.bincount(inverse.ravel(), weights=np.concatenate(windowCounts), minlength=barcodes.size).astype(np.int64)
+    return barcodes, counts
+
+
+#########################################################################################################################
+
+barcodeNames = index.barcodeNamesArray
+if len(args.regions) == 1:
+    barcodes, counts = region_barcodes(args.regions[0])
+    for barcode, count in zip(barcodes, counts):
+        outFile.write("{}\t{}\n".format(barcodeNames[barcode], count))
+else:
+    barcodes1, counts1 = region_barcodes(args.regions[0])
+    barcodes2, counts2 = region_barcodes(args.regions[1])
+    shared, in1, in2 = np.intersect1d(barcodes1, barcodes2, assume_unique=True, return_indices=True)
+    for barcode, count1, count2 in zip(shared, counts1[in1], counts2[in2]):
+        outFile.write("{}\t{}\t{}\n".format(barcodeNames[barcode], count1, count2))
+    union = barcodes1.size + barcodes2.size - shared.size
+    outFile.write("#jaccard\t{}\n".format(shared.size / union if union > 0 else float("nan")))
+
+outFile.close()
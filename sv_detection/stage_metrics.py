@@ -0,0 +1,141 @@
+#!/usr/bin/env python
+# Description: Performance metrics of a wrath stage (wall and CPU time, peak memory, bytes read and written, counts with their
+#              rates, and sampled values such as queue depths), appended as one json line to a metrics log
+# Usage: from stage_metrics import StageMetrics, measure_task
+#        metrics = StageMetrics(metrics_file, stage, **info); metrics.count("reads"); metrics.write()
+#        result, usage = measure_task(function, *args) (in a pool worker); metrics.add_task(usage) (in the main process)
+#        python stage_metrics.py wrath_out/metrics_*.jsonl (summary of the time and memory used by each stage of each chromosome)
+# Modules required: sys, os, json, time, resource, threading
+#########################################################################################################################
+
+import sys, os, json, time, resource
+from threading import Thread
+
+
+#########################################################################################################################
+
+'''Bytes read and written by this process so far (from /proc, so only on Linux), including reads from the page cache'''
+def io_bytes():
+    try:
+        with open("/proc/self/io", "rt") as io:
+            values = dict(line.split(":") for line in io)
+        return int(values["rchar"]), int(values["wchar"])
+    except (OSError, KeyError, ValueError):
+        return None, None
+
+
+'''Run function(*args) and return its result with the resources used to run it in this process: the time it took (busy_s),
+user and system CPU time, and the peak memory of the process. Tasks of a pool are measured with this in the worker and their
+usage is added to the stage with StageMetrics.add_task, as the main process only sees the resource use of its child
+processes once they have been joined, which for a pool that lives for the whole run is after every stage. Counts to add to
+the stage (e.g. reads) can be put in usage["counts"].'''
+def measure_task(function, *args, **kwargs):
+    startTime = time.time()
+    startUsage = resource.getrusage(resource.RUSAGE_SELF)
+    result = function(*args, **kwargs)
+    usage = resource.getrusage(resource.RUSAGE_SELF)
+    return result, {"pid": os.getpid(), "busy_s": time.time() - startTime,
+                    "cpu_user_s": usage.ru_utime - startUsage.ru_utime, "cpu_sys_s": usage.ru_stime - startUsage.ru_stime,
+                    "peak_rss_mb": usage.ru_maxrss / 1024, "counts": {}}
+
+
+'''Metrics of one stage. Nothing is written if metricsFile is None, so scripts can always collect them. Resource use
+includes child processes (e.g. worker processes) once they have been joined, and tasks run by the workers of a pool that are
+added with add_task.'''
+class StageMetrics:
+    def __init__(self, metricsFile, stage, **info):
+        self.metricsFile = metricsFile
+        self.stage = stage
+        self.info = info
+        self.counts = {}
+        self.gauges = {}
+        #tasks run by the workers of a pool: their number, busy and CPU time, and the peak memory of each worker
+        self.tasks = 0
+        self.taskBusy = 0
+        self.taskUser = 0
+        self.taskSys = 0
+        self.workerRss = {}
+        self.written = False
+        self.startTime = time.time()
+        self.startSelf = resource.getrusage(resource.RUSAGE_SELF)
+        self.startChildren = resource.getrusage(resource.RUSAGE_CHILDREN)
+        self.startRead, self.startWritten = io_bytes()
+
+    #add to a count (e.g. reads or rows written), which is reported with its rate per second
+    def count(self, name, n=1):
+        self.counts[name] = self.counts.get(name, 0) + n
+
+    #record a sampled value (e.g. a queue depth), which is reported as its mean and maximum
+    def gauge(self, name, value):
+        n, total, maximum = self.gauges.get(name, (0, 0, value))
+        self.gauges[name] = (n + 1, total + value, max(maximum, value))
+
+    #add the usage of a task run by a worker of a pool, as measured there with measure_task, and its counts
+    def add_task(self, usage):
+        self.tasks += 1
+        self.taskBusy += usage["busy_s"]
+        self.taskUser += usage["cpu_user_s"]
+        self.taskSys += usage["cpu_sys_s"]
+        self.workerRss[usage["pid"]] = max(self.workerRss.get(usage["pid"], 0), usage["peak_rss_mb"])
+        for name, n in usage.get("counts", {}).items(): self.count(name, n)
+
+    #sample the values returned by a function (as a dictionary of name: value) every interval seconds, in a background thread,
+    #until the metrics are written
+    def sample(self, values, interval=1):
+        def sampler():
+            while not self.written:
+                for name, value in values().items(): self.gauge(name, value)
+                time.sleep(interval)
+        samplerThread = Thread(target=sampler)
+        samplerThread.daemon = True
+        samplerThread.start()
+
+    def summary(self, **extra):
+        wall = time.time() - self.startTime
+        usageSelf = resource.getrusage(resource.RUSAGE_SELF)
+        usageChildren = resource.getrusage(resource.RUSAGE_CHILDREN)
+        read, written = io_bytes()
+        record = {"time": time.strftime("%Y-%m-%dT%H:%M:%S"), "stage": self.stage, "script": os.path.basename(sys.argv[0])}
+        record.update(self.info)
+        record.update({"wall_s": round(wall, 3),
+                       "cpu_user_s": round(usageSelf.ru_utime - self.startSelf.ru_utime + usageChildren.ru_utime - self.startChildren.ru_utime
+                                           + self.taskUser, 3),
+                       "cpu_sys_s": round(usageSelf.ru_stime - self.startSelf.ru_stime + usageChildren.ru_stime - self.startChildren.ru_stime
+                                          + self.taskSys, 3),
+                       #ru_maxrss is in kb on Linux
+                       "peak_rss_mb": round(max([usageSelf.ru_maxrss / 1024, usageChildren.ru_maxrss / 1024] + list(self.workerRss.values())), 1),
+                       "bytes_read": read - self.startRead if read is not None else None,
+                       "bytes_written": written - self.startWritten if written is not None else None,
+                       "counts": self.counts,
+                       "rates_per_s": dict((name, round(n / wall, 1) if wall > 0 else None) for name, n in self.counts.items()),
+                       "gauges": dict((name, {"mean": round(total / n, 2), "max": maximum}) for name, (n, total, maximum) in list(self.gauges.items()))})
+        if self.tasks > 0:
+            #the peak memory of each worker is over its whole life, so their sum is an upper bound of what they used together
+            record.update({"tasks": self.tasks, "worker_busy_s": round(self.taskBusy, 3),
+                           "workers_peak_rss_mb": round(sum(self.workerRss.values()), 1)})
+            #fraction of the time of the stage that the workers (threads, if given with the information of the stage) were busy
+            if self.info.get("threads"):
+                record["worker_utilisation"] = round(self.taskBusy / (self.info["threads"] * wall), 3) if wall > 0 else None
+        record.update(extra)
+        return record
+
+    #append the metrics as one json line to the metrics file
+    def write(self, **extra):
+        self.written = True
+        if self.metricsFile is None: return
+        with open(self.metricsFile, "at") as metricsFile:
+            metricsFile.write(json.dumps(self.summary(**extra)) + "\n")
+
+
+#########################################################################################################################
+
+'''Print the wall time, CPU time and peak memory of each stage in metrics logs, per chromosome, with wrath's own timing of
+each stage and the metrics written by the scripts it ran'''
+if __name__ == "__main__":
+    columns = ["chromosome", "stage", "script", "wall_s", "cpu_user_s", "cpu_sys_s", "peak_rss_mb"]
+    sys.stdout.write("\t".join(columns) + "\n")
+    for metricsFile in sys.argv[1:]:
+        with open(metricsFile, "rt") as metrics:
+            for line in metrics:
+                record = json.loads(line)
+                sys.stdout.write("\t".join(str(record.get(column, "")) for column in columns) + "\n")
@@ -68,7 +68,7 @@ outliers_file.loc[:, 'group']=clustering.labels_
 
 # Identification of breakpoints
 groups=outliers_file.groupby(['group'])
-d={'mincol':groups.min(['ncol'])['ncol'], 'maxcol':groups.max(['ncol'])['ncol'], 'minrow':groups.min(['nrow'])['nrow'], 'maxrow':groups.max(['nrow'])['nrow']}
+d={'mincol':groups['ncol'].min(), 'maxcol':groups['ncol'].max(), 'minrow':groups['nrow'].min(), 'maxrow':groups['nrow'].max()}
 breakPoints = pd.DataFrame(data=d)
 
 #plot heatmap in half a triangle and the detected outliers in the other
@@ -0,0 +1,153 @@
+#!/usr/bin/env python
+# Description: Scheduling of the jaccard matrix as tiles, shared by jaccard_matrix_simplequeue.py (worker processes fed by
+#              queues) and wrath (tasks of its process pool). The upper triangle of the matrix is split into tiles grouped
+#              by block of rows, blocks are only queued when there is space for them in the sorter buffer (a Semaphore),
+#              and a sorter thread puts the tiles of each block together and sends its rows in order to a writer thread
+# Usage: from tile_scheduler import make_tiles, tile_values, TileStats, queue_tiles, sort_tiles, write_rows, write_matrix_row
+#        blocks = make_tiles(n_rows, n_cols, tile_size); blockSlots = Semaphore(max_blocks); stats = TileStats()
+#        Thread(target=sort_tiles, args=(get_result, put_row, blocks, n_groups, n_cols, blockSlots, n_workers, stats)).start()
+#        Thread(target=write_rows, args=(get_row, out_files, diff_file, stats)).start()
+#        queue_tiles(blocks, put_tile, blockSlots, stats)
+# Modules required: sys, numpy, window_barcodes, profiling
+#########################################################################################################################
+
+import sys
+import numpy as np
+
+from window_barcodes import jaccard_values
+from profiling import Profiler
+
+
+#########################################################################################################################
+
+'''split the upper triangle of the matrix into tiles of at most tileSize x tileSize windows. Tiles are grouped by block of rows,
+so that block i has tiles for columns from the start of the block to the end of the matrix. Apart from those on the diagonal
+(which are half empty) all tiles need the same number of comparisons.'''
+def make_tiles(nRows, nCols, tileSize):
+    blocks = []
+    for rowStart in range(0, nRows, tileSize):
+        rowEnd = min(rowStart + tileSize, nRows)
+        blocks.append([(rowStart, rowEnd, colStart, min(colStart + tileSize, nCols)) for colStart in range(rowStart, nCols, tileSize)])
+    return blocks
+
+
+'''Jaccard indices of a tile for every group. groupWindows has, for each group, the barcodes of each window (anything that
+gives the barcodes of window w with [w], e.g. a list of arrays). inWindow is a boolean array with one value per barcode,
+kept by each worker between tiles.'''
+def tile_values(tile, groupWindows, inWindow):
+    rowStart, rowEnd, colStart, colEnd = tile
+    nRows = rowEnd - rowStart
+    #windows before the diagonal are not compared, so are left as 0
+    outArray = np.zeros((len(groupWindows), nRows, colEnd - colStart))
+    for groupNumber, windows in enumerate(groupWindows):
+        #rows first and then columns, so that local window numbers are rows 0..nRows-1 and columns nRows..
+        windowBarcodes = [windows[w] for w in list(range(rowStart, rowEnd)) + list(range(colStart, colEnd))]
+        for windowNumber in range(rowStart, rowEnd):
+            firstCol = max(windowNumber, colStart)
+            if firstCol >= colEnd: continue
+            outArray[groupNumber, windowNumber - rowStart, firstCol - colStart:] = jaccard_values(
+                windowBarcodes, windowNumber - rowStart, range(nRows + firstCol - colStart, nRows + colEnd - colStart), inWindow)
+    return outArray
+
+
+'''Counts of the tiles and rows going through the scheduler, to report progress and queue depths, and the time the workers
+spent computing tiles, to report how busy they were'''
+class TileStats:
+    def __init__(self):
+        self.tilesQueued = 0
+        self.tilesReceived = 0
+        self.rowsSorted = 0
+        self.rowsWritten = 0
+        self.busy = 0
+
+    #tiles waiting for or being computed by a worker, and rows waiting to be written (sampled by StageMetrics)
+    def pending(self):
+        return {"tiles_pending": self.tilesQueued - self.tilesReceived, "rows_pending": self.rowsSorted - self.rowsWritten}
+
+    #fraction of the time of nWorkers workers over seconds that they spent computing tiles
+    def utilisation(self, nWorkers, seconds):
+        return round(self.busy / (nWorkers * seconds), 3) if seconds > 0 else None
+
+
+'''Hand out the tiles to the workers with putTile(blockNumber, tile), in order of blocks of rows. A block is only queued when
+there is a slot for it in blockSlots (released by sort_tiles once the block is written), which bounds the memory used by
+blocks waiting to be written. Queueing stops early if stop() becomes true (e.g. after a worker failed).'''
+def queue_tiles(blocks, putTile, blockSlots, stats, profiler=None, stop=None):
+    profiler = profiler if profiler else Profiler(None, None)
+    putTile = profiler.timed("transfer", putTile)
+    for blockNumber, tiles in enumerate(blocks):
+        blockSlots.acquire()
+        if stop and stop(): return
+        for tile in tiles:
+            putTile(blockNumber, tile)
+            stats.tilesQueued += 1
+
+
+'''a function that gets the results of the tiles with getResult, as they come. Results are (blockNumber, colStart, values),
+and each of the nWorkers workers ends with (-1, None, busy), busy being the time it spent computing (or None if this is
+counted elsewhere). Once all tiles of the next block are in, its rows are sent in order with putRow(rowNumber, values), the
+values being one row for each group, and the block is released from the buffer, which lets the next block be queued.
+putRow(-1, None) is sent at the end.'''
+def sort_tiles(getResult, putRow, blocks, nGroups, nCols, blockSlots, nWorkers, stats, verbose=False, profileDir=None):
+    profiler = Profiler(profileDir, "sorter").start()
+    getResult = profiler.timed("transfer", getResult)
+    putRow = profiler.timed("transfer", putRow)
+    sortBuffer = {}
+    expect = 0
+    workersComplete = 0 #this will keep track of the workers and once they're all done this thread will break
+    while True:
+        blockNumber, colStart, results = getResult()
+        #check if we're done
+        if blockNumber == -1:
+            workersComplete += 1
+            if results is not None: stats.busy += results
+            if workersComplete == nWorkers:
+                putRow(-1, None)
+                profiler.stop()
+                break #this is the way of telling everything we're done
+            continue
+        stats.tilesReceived += 1
+        if verbose:
+            sys.stderr.write("Sorter received tile {}:{} of block {}\n".format(colStart, colStart + results.shape[2], blockNumber))
+        rowStart, rowEnd = blocks[blockNumber][0][:2]
+        if blockNumber not in sortBuffer:
+            sortBuffer[blockNumber] = [np.zeros((nGroups, rowEnd - rowStart, nCols)), len(blocks[blockNumber])]
+        sortBuffer[blockNumber][0][:, :, colStart:colStart + results.shape[2]] = results
+        sortBuffer[blockNumber][1] -= 1
+        #send any complete blocks that are next in line to the writer
+        while expect in sortBuffer and sortBuffer[expect][1] == 0:
+            blockResults = sortBuffer.pop(expect)[0]
+            for row in range(blockResults.shape[1]):
+                putRow(blocks[expect][0][0] + row, blockResults[:, row])
+                stats.rowsSorted += 1
+            if verbose:
+                sys.stderr.write("block {} sent to writer\n".format(expect))
+            expect += 1
+            blockSlots.release()
+
+
+'''Write one row of a matrix, in the same format as np.savetxt(fmt='%.10f') with values separated by commas (and a comma at
+the end of the line with trailingComma, as np.savetxt(newline=','))'''
+def write_matrix_row(outFile, values, trailingComma=False):
+    outFile.write(",".join(["%.10f" % value for value in values]) + ("," if trailingComma else "") + "\n")
+
+
+'''a writer function that gets the sorted rows with getRow and writes them, one row to the matrix of each group (and the
+difference between the first two groups if diffOut is given), until it gets row -1'''
+def write_rows(getRow, outs, diffOut, stats, verbose=False, profileDir=None, trailingComma=False):
+    profiler = Profiler(profileDir, "writer").start()
+    getRow = profiler.timed("transfer", getRow)
+    while True:
+        windowNumber, results = getRow()
+        #check if we're done
+        if windowNumber == -1:
+            profiler.stop()
+            break
+        if verbose:
+            sys.stderr.write("Writer received window {}\n".format(windowNumber))
+        with profiler.phase("write"):
+            for out, groupResults in zip(outs, results):
+                write_matrix_row(out, groupResults, trailingComma)
+            if diffOut:
+                write_matrix_row(diffOut, results[0] - results[1], trailingComma)
+        stats.rowsWritten += 1
@@ -0,0 +1,206 @@
+#!/usr/bin/env python
+# Description: Functions to read the barcodes in each genomic window once, as sorted arrays of unique integer barcode ids
+# Usage: from window_barcodes import sample_name, sample_names, read_window_barcodes, read_group_window_barcodes, filter_window_barcodes, jaccard_values
+#        from window_barcodes import bam_barcode_reads, read_bam_window_barcodes, save_sample_index, load_sample_index, intersection_counts
+# Input: barcode_file = tabix indexed barcode bed file (as made by wrath)
+#        bam_file = indexed bam file with barcodes stored in the BX tag
+#        windows = data frame with genomic window positions
+# Modules required: sys, os, re, pysam, numpy, profiling
+#########################################################################################################################
+
+import sys, os, re, pysam
+import numpy as np
+
+from profiling import Profiler
+
+
+#########################################################################################################################
+
+'''Name of a sample from its bam file (the file name without .bam), as used in the sample column of barcode files'''
+def sample_name(bamFile):
+    name = os.path.basename(bamFile)
+    return name[:-4] if name.endswith(".bam") else name
+
+
+'''Sample names of a list of bam files (the same file can be listed more than once, e.g. in several groups). As samples are
+named after their bam files, bam files with the same name in different directories would be taken as a single sample, and
+share its files in the per-sample index, so these raise a ValueError.'''
+def sample_names(bamFiles):
+    samplePaths = {}
+    for bamFile in bamFiles:
+        samplePaths.setdefault(sample_name(bamFile), set()).add(os.path.abspath(bamFile))
+    duplicates = ["{} ({})".format(sample, ", ".join(sorted(paths))) for sample, paths in samplePaths.items() if len(paths) > 1]
+    if len(duplicates) > 0:
+        raise ValueError("Bam files in different directories have the same sample name: {}".format("; ".join(duplicates)))
+    return [sample_name(bamFile) for bamFile in bamFiles]
+
+
+'''Read the barcodes of all windows. Each barcode name is given an integer id (its position in the returned list of names)
+and each window gets a sorted array of the unique ids found in it, plus an array with the number of reads for each of them.
+If a profiler is given, the time spent fetching reads, parsing barcodes and computing the arrays is timed.'''
+def read_window_barcodes(inFile, windows, profiler=None):
+    profiler = profiler if profiler else Profiler(None, None)
+    barcodeIds = {}
+    windowBarcodes = []
+    windowCounts = []
+    for windowIdx, windowLine in windows.iterrows():
+        with profiler.phase("fetch"):
+            bedfile = list(inFile.fetch(windowLine[0], windowLine[1], windowLine[2], parser=pysam.asBed(), multiple_iterators=True))
+        with profiler.phase("parse"):
+            ids = [barcodeIds.setdefault(rowbed.name, len(barcodeIds)) for rowbed in bedfile]
+        with profiler.phase("compute"):
+            barcodes, counts = np.unique(np.array(ids, dtype=np.int64), return_counts=True)
+        windowBarcodes.append(barcodes)
+        windowCounts.append(counts)
+    barcodeNames = list(barcodeIds.keys())
+    return barcodeNames, windowBarcodes, windowCounts
+
+
+'''Read the barcodes of all windows for several groups of samples at once. This needs a barcode file with the sample name of
+each read in the fifth column (as made by get_barcodes.py with --sample). Barcode ids are shared by all groups, and for each
+group each window gets a sorted array of the unique ids found in the reads of its samples, plus their read counts.
+Phases are timed as in read_window_barcodes.'''
+def read_group_window_barcodes(inFile, windows, groups, profiler=None):
+    profiler = profiler if profiler else Profiler(None, None)
+    barcodeIds = {}
+    groupBarcodes = [[] for group in groups]
+    groupCounts = [[] for group in groups]
+    for windowIdx, windowLine in windows.iterrows():
+        with profiler.phase("fetch"):
+            bedfile = list(inFile.fetch(windowLine[0], windowLine[1], windowLine[2], parser=pysam.asTuple(), multiple_iterators=True))
+        with profiler.phase("parse"):
+            ids = []
+            samples = []
+            for rowbed in bedfile:
+                if len(rowbed) < 5:
+                    raise ValueError("Barcode file has no sample column, which is needed to compare groups of samples")
+                ids.append(barcodeIds.setdefault(rowbed[3], len(barcodeIds)))
+                samples.append(rowbed[4])
+        with profiler.phase("compute"):
+            ids = np.array(ids, dtype=np.int64)
+            for groupNumber, group in enumerate(groups):
+                inGroup = np.array([sample in group for sample in samples], dtype=bool)
+                barcodes, counts = np.unique(ids[inGroup], return_counts=True)
+                groupBarcodes[groupNumber].append(barcodes)
+                groupCounts[groupNumber].append(counts)
+    barcodeNames = list(barcodeIds.keys())
+    return barcodeNames, groupBarcodes, groupCounts
+
+
+'''Leftmost mapping position (1-based) and barcode (as BX:Z:barcode) of the reads of an open bam file in a region (0-based
+start, as in pysam), keeping reads with mapping quality of at least minMapQ and a BX tag. This is how barcodes are read from
+bam files everywhere, by read_bam_window_barcodes and by get_barcodes.py.'''
+def bam_barcode_reads(bam, chromosome, start=None, end=None, minMapQ=20):
+    for read in bam.fetch(chromosome, start, end):
+        if read.mapping_quality < minMapQ or not read.has_tag("BX"): continue
+        yield read.reference_start + 1, "BX:Z:" + read.get_tag("BX")
+
+
+'''Read the barcodes of all windows for a single sample straight from its bam file, with bam_barcode_reads (reads placed
+at their leftmost mapping position). Returns the same as read_window_barcodes.'''
+def read_bam_window_barcodes(bamFile, windows, minMapQ=20):
+    barcodeIds = {}
+    windowBarcodes = [None] * windows.shape[0]
+    windowCounts = [None] * windows.shape[0]
+    with pysam.AlignmentFile(bamFile, "rb") as bam:
+        for chromosome, chromWindows in windows.groupby(0, sort=False):
+            windowStarts = chromWindows[1].to_numpy(dtype=np.int64)
+            windowEnds = chromWindows[2].to_numpy(dtype=np.int64)
+            positions = []
+            ids = []
+            for position, barcode in bam_barcode_reads(bam, chromosome, int(windowStarts.min()), int(windowEnds.max()), minMapQ):
+                positions.append(position)
+                ids.append(barcodeIds.setdefault(barcode, len(barcodeIds)))
+            positions = np.array(positions, dtype=np.int64)
+            ids = np.array(ids, dtype=np.int64)
+            #reads come sorted by position, so the reads of each window are a slice. As tabix does with the barcode files
+            #(where each read is a zero length interval at its position p), a read is in a window if start < p < end
+            first = np.searchsorted(positions, windowStarts, side="right")
+            last = np.searchsorted(positions, windowEnds, side="left")
+            for windowNumber, start, end in zip(np.flatnonzero((windows[0] == chromosome).to_numpy()), first, last):
+                windowBarcodes[windowNumber], windowCounts[windowNumber] = np.unique(ids[start:end], return_counts=True)
+    barcodeNames = list(barcodeIds.keys())
+    return barcodeNames, windowBarcodes, windowCounts
+
+
+'''Window positions as saved in sample indices (chromosome names and start and end positions)'''
+def window_positions(windows):
+    return windows[0].to_numpy(dtype=str), windows[1].to_numpy(dtype=np.int64), windows[2].to_numpy(dtype=np.int64)
+
+
+'''Save the barcodes of each window of a sample, so that they don't need to be read from its bam file again. The window
+positions and the minimum mapping quality of the reads are saved with them, so that the index is only used for the same
+windows and reads.'''
+def save_sample_index(indexFile, barcodeNames, windowBarcodes, windowCounts, windows, minMapQ=20):
+    chromosomes, starts, ends = window_positions(windows)
+    offsets = np.zeros(len(windowBarcodes) + 1, dtype=np.int64)
+    offsets[1:] = np.cumsum([barcodes.size for barcodes in windowBarcodes])
+    with open(indexFile, "wb") as out:
+        np.savez_compressed(out, barcodeNames=np.array(barcodeNames, dtype=str), offsets=offsets,
+                            barcodes=np.concatenate(windowBarcodes + [np.zeros(0, dtype=np.int64)]),
+                            counts=np.concatenate(windowCounts + [np.zeros(0, dtype=np.int64)]),
+                            chromosomes=chromosomes, starts=starts, ends=ends, min_map_q=minMapQ)
+
+
+'''Load the barcodes of each window of a sample saved with save_sample_index. Returns None if the index was made for
+other windows or another minimum mapping quality.'''
+def load_sample_index(indexFile, windows, minMapQ=20):
+    chromosomes, starts, ends = window_positions(windows)
+    with np.load(indexFile) as index:
+        if "min_map_q" not in index.files or int(index["min_map_q"]) != minMapQ:
+            return None
+        if not (np.array_equal(index["chromosomes"], chromosomes) and np.array_equal(index["starts"], starts)
+                and np.array_equal(index["ends"], ends)):
+            return None
+        offsets = index["offsets"]
+        barcodes = index["barcodes"]
+        counts = index["counts"]
+        barcodeNames = list(index["barcodeNames"])
+    windowBarcodes = [barcodes[offsets[i]:offsets[i+1]] for i in range(len(offsets) - 1)]
+    windowCounts = [counts[offsets[i]:offsets[i+1]] for i in range(len(offsets) - 1)]
+    return barcodeNames, windowBarcodes, windowCounts
+
+
+'''Number of windows each barcode is found in'''
+def barcode_spans(windowBarcodes, nBarcodes):
+    if len(windowBarcodes) == 0: return np.zeros(nBarcodes, dtype=np.int64)
+    return np.bincount(np.concatenate(windowBarcodes), minlength=nBarcodes)
+
+
+'''Drop uninformative barcodes from every window: barcodes with fewer than min_reads reads in a window are dropped
+from that window, and barcodes with a missing code (e.g. A00, which parse_haptag_barcodes.py gives when a barcode
+can't be matched) or that are found in more than max_windows windows are dropped from all of them.'''
+def filter_window_barcodes(barcodeNames, windowBarcodes, windowCounts, exclude_invalid=False, max_windows=None, min_reads=1):
+    if min_reads > 1:
+        windowBarcodes = [barcodes[counts >= min_reads] for barcodes, counts in zip(windowBarcodes, windowCounts)]
+        windowCounts = [counts[counts >= min_reads] for counts in windowCounts]
+    keep = np.ones(len(barcodeNames), dtype=bool)
+    if exclude_invalid:
+        missingCode = re.compile("[ABCD]00")
+        keep &= np.array([missingCode.search(barcode) is None for barcode in barcodeNames], dtype=bool)
+    if max_windows is not None:
+        keep &= barcode_spans(windowBarcodes, len(barcodeNames)) <= max_windows
+    if not keep.all():
+        sys.stderr.write("Excluding {} of {} barcodes\n".format(len(barcodeNames) - keep.sum(), len(barcodeNames)))
+        windowCounts = [counts[keep[barcodes]] for barcodes, counts in zip(windowBarcodes, windowCounts)]
+        windowBarcodes = [barcodes[keep[barcodes]] for barcodes in windowBarcodes]
+    return windowBarcodes, windowCounts
+
+
+'''Number of barcodes shared by window index1 and each of the windows in indices2. inWindow is a boolean array with one
+entry per barcode (all False), which is used to mark the barcodes of window 1 and is reset before returning.'''
+def intersection_counts(windowBarcodes, index1, indices2, inWindow):
+    barcodes1 = windowBarcodes[index1]
+    inWindow[barcodes1] = True
+    array_i = np.array([np.count_nonzero(inWindow[windowBarcodes[index2]]) for index2 in indices2], dtype=np.int64)
+    inWindow[barcodes1] = False
+    return array_i
+
+
+'''Exact jaccard index between window index1 and each of the windows in indices2 (see intersection_counts).
+Pairs of windows without any barcodes give nan, as the union is empty.'''
+def jaccard_values(windowBarcodes, index1, indices2, inWindow):
+    array_i = intersection_counts(windowBarcodes, index1, indices2, inWindow).astype(np.float64)
+    array_u = np.array([windowBarcodes[index1].size + windowBarcodes[index2].size for index2 in indices2], dtype=np.float64) - array_i
+    with np.errstate(invalid='ignore'):
+        return np.divide(array_i, array_u)
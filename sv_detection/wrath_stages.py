@@ -0,0 +1,305 @@
+#!/usr/bin/env python
+# Description: Stages of the wrath pipeline as functions that run in the processes of a single pool. Barcodes, windows and
+#              matrix tiles are passed between stages as numpy arrays (the barcodes of a matrix are memory-mapped by the
+#              workers, and tiles are scheduled as in jaccard_matrix_simplequeue.py, see tile_scheduler.py), and the
+#              plotting, outlier and SV scripts are run as tasks of a dataflow graph, so that stages that don't depend on
+#              each other run at the same time. Tasks of the workers return the resources they used (see stage_metrics.py)
+#              and can be profiled (see profiling.py)
+# Usage: from wrath_stages import read_sample_barcodes, merge_sample_barcodes, sample_index_arrays, flat_barcodes
+#        from wrath_stages import save_group_barcodes, compute_matrices, run_steps, run_graph, strip_trailing_commas
+# Modules required: sys, os, time, runpy, shutil, tempfile, subprocess, traceback, queue, threading, numpy, window_barcodes,
+#                   stage_metrics, profiling, tile_scheduler
+#########################################################################################################################
+
+import sys, os, time, runpy, shutil, tempfile, subprocess, traceback
+from queue import Queue
+from threading import Thread, Semaphore, Condition
+import numpy as np
+
+from window_barcodes import read_bam_window_barcodes
+from stage_metrics import StageMetrics, measure_task
+from profiling import Profiler
+from tile_scheduler import make_tiles, tile_values, TileStats, queue_tiles, sort_tiles, write_rows
+
+
+#########################################################################################################################
+
+#profiling
+
+#profile of the tasks run by a worker, kept between tasks
+workerProfiler = None
+
+'''Profiler of the tasks of this worker, which is started for each task and stopped (saved) after it, so that the profile
+of a worker is complete whenever its tasks are done'''
+def worker_profiler(profileDir):
+    global workerProfiler
+    if workerProfiler is None or workerProfiler.profileDir != profileDir:
+        workerProfiler = Profiler(profileDir, "worker")
+    return workerProfiler
+
+
+#########################################################################################################################
+
+#barcodes
+
+'''Read the barcodes of all windows of one sample from its bam file (a pool task). Returns the same as read_bam_window_barcodes,
+and the resources used by the task in the worker, with the number of reads in the windows.'''
+def read_sample_barcodes(bamFile, windows, minMapQ=20, profileDir=None):
+    def read():
+        profiler = worker_profiler(profileDir).start()
+        with profiler.phase("fetch"): sampleBarcodes = read_bam_window_barcodes(bamFile, windows, minMapQ)
+        profiler.stop()
+        return sampleBarcodes
+    sampleBarcodes, usage = measure_task(read)
+    usage["counts"] = {"reads": sum(int(counts.sum()) for counts in sampleBarcodes[2])}
+    return sampleBarcodes, usage
+
+
+'''Put the barcodes of the samples (read with read_sample_barcodes, in the order of sampleNames) together, giving each barcode
+a single id shared by all samples. Returns the barcode names, the ids of each sample's barcodes (in the order of that sample's
+names), and for each group the same as read_group_window_barcodes: for each window a sorted array of the unique ids found
+in its samples, plus their read counts.'''
+def merge_sample_barcodes(sampleNames, sampleBarcodes, groups):
+    barcodeIds = {}
+    sampleIds = []
+    for names, windowBarcodes, windowCounts in sampleBarcodes:
+        sampleIds.append(np.array([barcodeIds.setdefault(name, len(barcodeIds)) for name in names], dtype=np.int64))
+    nWindows = len(sampleBarcodes[0][1]) if len(sampleBarcodes) > 0 else 0
+    groupBarcodes = []
+    groupCounts = []
+    for group in groups:
+        sampleNumbers = [sampleNames.index(sample) for sample in group if sample in sampleNames]
+        windowBarcodes = []
+        windowCounts = []
+        for windowNumber in range(nWindows):
+            ids = np.concatenate([sampleIds[s][sampleBarcodes[s][1][windowNumber]] for s in sampleNumbers] + [np.zeros(0, dtype=np.int64)])
+            counts = np.concatenate([sampleBarcodes[s][2][windowNumber] for s in sampleNumbers] + [np.zeros(0, dtype=np.int64)])
+            barcodes, inverse = np.unique(ids, return_inverse=True)
+            windowBarcodes.append(barcodes)
+            windowCounts.append(np.bincount(inverse.ravel(), weights=counts, minlength=barcodes.size).astype(np.int64))
+        groupBarcodes.append(windowBarcodes)
+        groupCounts.append(windowCounts)
+    return list(barcodeIds.keys()), sampleIds, groupBarcodes, groupCounts
+
+
+'''Keys and counts of the barcodes of each window of each sample, as read by build_barcode_index, so that the barcodes read
+from the bam files can be written to a barcode index with write_barcode_index'''
+def sample_index_arrays(sampleBarcodes, sampleIds):
+    nWindows = len(sampleBarcodes[0][1]) if len(sampleBarcodes) > 0 else 0
+    windowKeys = []
+    windowCounts = []
+    for windowNumber in range(nWindows):
+        keys = np.concatenate([sampleNumber * (2**32) + sampleIds[sampleNumber][windowBarcodes[windowNumber]]
+                               for sampleNumber, (names, windowBarcodes, counts) in enumerate(sampleBarcodes)] + [np.zeros(0, dtype=np.int64)])
+        counts = np.concatenate([counts[windowNumber] for names, windowBarcodes, counts in sampleBarcodes] + [np.zeros(0, dtype=np.int64)])
+        order = np.argsort(keys, kind="stable")
+        windowKeys.append(keys[order])
+        windowCounts.append(counts[order])
+    return windowKeys, windowCounts
+
+
+'''Barcodes of all windows as one array, with the offset of the barcodes of each window in it, so that the barcodes of a
+range of windows are a single slice that is quick to send to another process'''
+def flat_barcodes(windowBarcodes):
+    offsets = np.zeros(len(windowBarcodes) + 1, dtype=np.int64)
+    offsets[1:] = np.cumsum([barcodes.size for barcodes in windowBarcodes])
+    return np.concatenate(windowBarcodes + [np.zeros(0, dtype=np.int64)]), offsets
+
+
+#########################################################################################################################
+
+#matrix
+
+#marks the barcodes of a window, kept by each worker between tiles
+inWindow = np.zeros(0, dtype=bool)
+
+#barcodes of each group of the matrix being computed, memory-mapped by each worker for its first tile of that matrix
+workerBarcodes = {}
+
+'''Save the barcodes of each group for the workers, flattened with flat_barcodes, so that they are written once and
+memory-mapped by each worker rather than sent with every tile'''
+def save_group_barcodes(barcodeDir, groupBarcodes):
+    for groupNumber, windowBarcodes in enumerate(groupBarcodes):
+        barcodes, offsets = flat_barcodes(windowBarcodes)
+        np.save(os.path.join(barcodeDir, "barcodes_{}.npy".format(groupNumber)), barcodes)
+        np.save(os.path.join(barcodeDir, "offsets_{}.npy".format(groupNumber)), offsets)
+
+
+'''Barcodes of each window, from the arrays made by flat_barcodes, as [w] gives them for window w'''
+class FlatWindows:
+    def __init__(self, barcodes, offsets):
+        self.barcodes = barcodes
+        self.offsets = offsets
+
+    def __getitem__(self, windowNumber):
+        return np.asarray(self.barcodes[self.offsets[windowNumber]:self.offsets[windowNumber + 1]])
+
+
+'''Barcodes of each window of each group saved with save_group_barcodes, memory-mapped once per worker'''
+def load_group_barcodes(barcodeDir, nGroups):
+    if barcodeDir not in workerBarcodes:
+        workerBarcodes.clear()
+        workerBarcodes[barcodeDir] = [FlatWindows(np.load(os.path.join(barcodeDir, "barcodes_{}.npy".format(groupNumber)), mmap_mode="r"),
+                                                  np.load(os.path.join(barcodeDir, "offsets_{}.npy".format(groupNumber))))
+                                      for groupNumber in range(nGroups)]
+    return workerBarcodes[barcodeDir]
+
+
+'''Jaccard indices of a tile for every group (a pool task), from the barcodes saved in barcodeDir. Returns the block of the
+tile and its first column, as sort_tiles takes them, its values and the resources used by the task in the worker.'''
+def tile_jaccard(blockNumber, tile, barcodeDir, nGroups, nBarcodes, profileDir=None):
+    def compute():
+        global inWindow
+        profiler = worker_profiler(profileDir).start()
+        if inWindow.size < nBarcodes: inWindow = np.zeros(nBarcodes, dtype=bool)
+        with profiler.phase("fetch"): groupWindows = load_group_barcodes(barcodeDir, nGroups)
+        with profiler.phase("compute"): outArray = tile_values(tile, groupWindows, inWindow[:nBarcodes])
+        profiler.stop()
+        return outArray
+    outArray, usage = measure_task(compute)
+    return blockNumber, tile[2], outArray, usage
+
+
+'''Compute the jaccard matrix of each group with the tiles spread over the threads workers of the pool, and write the rows
+of each matrix (and the difference between the first two if diffFile is given) in order as the blocks of rows are completed.
+Tiles are scheduled as by jaccard_matrix_simplequeue.py (see tile_scheduler.py): only maxBlocks blocks of rows are queued or
+waiting to be written at once, which bounds memory use, and a sorter and a writer thread put the tiles together and write the
+rows, without the comma at the end of each line. Barcodes are saved to a temporary directory in workDir for the workers, which
+is removed at the end. The usage of each tile task is added to metrics, with the tile and row queue depths, and the main
+process, sorter, writer and workers are profiled to profileDir if it is given. Returns the time spent computing and how busy
+the workers were, to log with the metrics of the stage.'''
+def compute_matrices(pool, threads, groupBarcodes, nBarcodes, outFiles, diffFile=None, tileSize=100, maxBlocks=2, workDir=None,
+                     verbose=False, metrics=None, profileDir=None):
+    computeStart = time.time()
+    nWindows = len(groupBarcodes[0])
+    nGroups = len(groupBarcodes)
+    blocks = make_tiles(nWindows, nWindows, tileSize)
+    blockSlots = Semaphore(maxBlocks)
+    stats = TileStats()
+    profiler = Profiler(profileDir, "main").start()
+    barcodeDir = tempfile.mkdtemp(prefix="matrix_barcodes_", dir=workDir)
+    try:
+        with profiler.phase("write"): save_group_barcodes(barcodeDir, groupBarcodes)
+        #results of the tiles go to the sorter, and rows from the sorter to the writer
+        resultQueue = Queue()
+        writeQueue = Queue()
+        sorterThread = Thread(target=sort_tiles, args=(resultQueue.get, lambda rowNumber, row: writeQueue.put((rowNumber, row)), blocks,
+                                                       nGroups, nWindows, blockSlots, 1, stats, verbose, profileDir))
+        writerThread = Thread(target=write_rows, args=(writeQueue.get, outFiles, diffFile, stats, verbose, profileDir))
+        for thread in [sorterThread, writerThread]:
+            thread.daemon = True
+            thread.start()
+        if metrics: metrics.sample(stats.pending)
+        #tiles are counted as they are queued and done (their results are not kept, as they would hold the whole matrix),
+        #and tiles that failed release a slot, so that no more blocks are queued
+        tileCounts = {"queued": 0, "done": 0}
+        progress = Condition()
+        errors = []
+        def tile_finished():
+            with progress:
+                tileCounts["done"] += 1
+                progress.notify()
+        def tile_done(result):
+            blockNumber, colStart, outArray, usage = result
+            stats.busy += usage["busy_s"]
+            if metrics: metrics.add_task(usage)
+            resultQueue.put((blockNumber, colStart, outArray))
+            tile_finished()
+        def tile_failed(error):
+            errors.append(error)
+            blockSlots.release()
+            tile_finished()
+        def put_tile(blockNumber, tile):
+            with progress: tileCounts["queued"] += 1
+            pool.apply_async(tile_jaccard, (blockNumber, tile, barcodeDir, nGroups, nBarcodes, profileDir), callback=tile_done, error_callback=tile_failed)
+        queue_tiles(blocks, put_tile, blockSlots, stats, profiler, lambda: len(errors) > 0)
+        with progress: progress.wait_for(lambda: tileCounts["done"] == tileCounts["queued"])
+        #all tiles are done, as the one worker of sort_tiles
+        resultQueue.put((-1, None, None))
+        sorterThread.join()
+        writerThread.join()
+    finally:
+        shutil.rmtree(barcodeDir, ignore_errors=True)
+        profiler.stop()
+    if len(errors) > 0: raise RuntimeError("Computing of tiles failed: {}".format(errors[0]))
+    computeTime = time.time() - computeStart
+    if metrics:
+        metrics.count("tiles", stats.tilesReceived)
+        metrics.count("rows_written", stats.rowsWritten)
+        metrics.count("comparisons", nWindows * (nWindows + 1) // 2 * nGroups)
+    return {"compute_s": round(computeTime, 3), "worker_utilisation": stats.utilisation(threads, computeTime)}
+
+
+'''Remove the comma at the end of each line of a matrix written by the matrix scripts'''
+def strip_trailing_commas(matrixFile):
+    with open(matrixFile, "rt") as matrix:
+        lines = [line.rstrip("\n") for line in matrix]
+    with open(matrixFile, "wt") as matrix:
+        for line in lines:
+            matrix.write((line[:-1] if line.endswith(",") else line) + "\n")
+
+
+#########################################################################################################################
+
+#tasks
+
+'''Run a python script in this process, as if it was run from the command line. The script's figures are closed afterwards,
+as processes run several scripts one after the other.'''
+def run_script(script, arguments):
+    argv = sys.argv
+    sys.argv = [script] + [str(argument) for argument in arguments]
+    try:
+        runpy.run_path(script, run_name="__main__")
+    except SystemExit as exit:
+        if exit.code not in (None, 0):
+            raise RuntimeError("{} failed: {}".format(os.path.basename(script), exit.code))
+    finally:
+        sys.argv = argv
+        if "matplotlib.pyplot" in sys.modules: sys.modules["matplotlib.pyplot"].close("all")
+
+
+'''Run the steps of a task one after the other (a pool task), logging its metrics. Steps are ("script", path, arguments) to
+run a python script in this process, ("command", arguments) to run a program, and ("strip", matrix_file) to remove the
+commas at the end of the lines of a matrix. Errors are raised as RuntimeError with the message of the task.'''
+def run_steps(steps, message, metricsFile=None, stage=None, **info):
+    metrics = StageMetrics(metricsFile, stage, **info)
+    try:
+        for step in steps:
+            if step[0] == "script": run_script(step[1], step[2])
+            elif step[0] == "command": subprocess.run([str(argument) for argument in step[1]], check=True)
+            elif step[0] == "strip": strip_trailing_commas(step[1])
+    except Exception as error:
+        raise RuntimeError("{} failed: {}\n{}".format(message, error, traceback.format_exc()))
+    metrics.write()
+
+
+'''Run a dataflow graph of tasks in the pool. Each task is a dictionary with its name, the names of the tasks it needs to
+wait for ("after"), its steps and message (see run_steps), and the stage and information to log its metrics with. Tasks are
+started as soon as the tasks they wait for are done, so independent tasks run at the same time. If a task fails no more
+tasks are started, and the names of the failed tasks are returned once the running ones are done.'''
+def run_graph(pool, tasks, metricsFile=None):
+    pending = list(tasks)
+    running = {}
+    done = set()
+    failed = []
+    while pending or running:
+        if not failed:
+            for task in [task for task in pending if all(name in done for name in task.get("after", []))]:
+                sys.stdout.write(task["message"] + "\n")
+                sys.stdout.flush()
+                running[task["name"]] = pool.apply_async(run_steps, (task["steps"], task["message"], metricsFile, task["stage"]),
+                                                          task.get("info", {}))
+                pending.remove(task)
+        if not running: break
+        time.sleep(0.05)
+        for name, result in list(running.items()):
+            if not result.ready(): continue
+            del running[name]
+            try:
+                result.get()
+                done.add(name)
+            except RuntimeError as error:
+                sys.stderr.write(str(error) + "\n")
+                failed.append(name)
+    #tasks that wait for a failed task are not run
+    return failed + [task["name"] for task in pending]